@@ -1,6 +1,12 @@
 import afskmodem
-import os
-from datetime import datetime
+import metrics
+import mercurylog
+import hashlib
+import random
+import threading
+import queue
+from collections import OrderedDict
+from time import sleep, monotonic
 """
 x-------------------------------------------------------------------------x
 | ADR-CFS (Asynchronous Digital Radio Communication Formatting Standard ) |
@@ -8,50 +14,23 @@ x-------------------------------------------------------------------------x
 x-------------------------------------------------------------------------x
 """
 ################################################################################ LOGGING
-def get_date_and_time(): # Long date and time for logging
-        now = datetime.now()
-        return now.strftime('%Y-%m-%d %H:%M:%S')
-
 # Logging level (0: INFO, 1: WARN (recommended), 2: ERROR, 3: NONE)
 LOG_LEVEL = 0
 #
-# Should the log output to the console?
-LOG_TO_CONSOLE = True
-#
-# Should the log output to a log file?
-LOG_TO_FILE = False
-#
-# Where to generate logfile if need be
-LOG_PATH = "adr-cfs.log"
-#
-# How the log identifies which module is logging.
+# How the log identifies which module is logging. (Log output is configured in mercurylog.py)
 LOG_PREFIX = "(ADR-CFS)"
 
-# Initialize log file if needed
-if(LOG_TO_FILE):
-    try:
-        os.remove(LOG_PATH)
-    except:
-        pass
-    with open(LOG_PATH, "w") as f:
-        f.write(get_date_and_time() + " [INFO] " + LOG_PREFIX + " Logging initialized.\n")
-
-def log(level: int, data: str):
-    if(level >= LOG_LEVEL):
-        output = get_date_and_time()
-        if(level == 0):
-            output += " [INFO] "
-        elif(level == 1):
-            output += " [WARN] "
-        else:
-            output += " [ERR!] "
-        output += LOG_PREFIX + " "
-        output += data
-        if(LOG_TO_FILE):
-            with open(LOG_PATH, "a") as f:
-                f.write(output + "\n")
-        if(LOG_TO_CONSOLE):
-            print(output)
+log = mercurylog.get_logger(LOG_PREFIX, LOG_LEVEL)
+
+################################################################################ Metrics
+PACKETS_SENT = metrics.counter("adrcfs_packets_sent_total", "Packets sent by NetworkInterfaces")
+PACKETS_RECEIVED = metrics.counter("adrcfs_packets_received_total", "Packets received by NetworkInterfaces")
+PACKETS_DISPATCHED = metrics.counter("adrcfs_packets_dispatched_total", "Subscriber callbacks made by NetworkInterfaces")
+PACKET_INTEGRITY = metrics.histogram("adrcfs_packet_integrity", "Integrity (1 - corrected bits per byte) of received transmissions",
+    buckets=(0.5, 0.7, 0.8, 0.9, 0.95, 0.99, 1))
+CSMA_DEFERRALS = metrics.counter("adrcfs_csma_deferrals_total", "Times a NetworkInterface found the channel busy and backed off")
+CSMA_FORCED = metrics.counter("adrcfs_csma_forced_total", "Packets sent on a busy channel after waiting the longest allowed")
+CSMA_WAIT_SECONDS = metrics.counter("adrcfs_csma_wait_seconds_total", "Time NetworkInterfaces spent waiting for a clear channel")
 
 ################################################################################ General utilities
 class FormatUtils:
@@ -142,18 +121,34 @@ class FormatUtils:
     # convert an integer from 0-255 to bits
     def int_to_bits(bData: int) -> str:
         return '{0:08b}'.format(bData)
+
+    # non-negative int to an unsigned LEB128 varint (7 bits per byte, least significant first)
+    def int_to_varint(data: int) -> bytes:
+        out = bytearray()
+        while(data > 0x7F):
+            out.append((data & 0x7F) | 0x80)
+            data >>= 7
+        out.append(data)
+        return bytes(out)
     
 ################################################################################ Wrapper class for digital radio interface
 class RadioInterface: 
-    def __init__(self):
-        self.receiver = afskmodem.DigitalReceiver(afskmodem.DigitalModulationTypes.afsk1200()) # see AFSKmodem README.md for more info on these
-        self.transmitter = afskmodem.DigitalTransmitter(afskmodem.DigitalModulationTypes.afsk1200())
+    # input_device: name or index of the sound card to receive on (None: system default)
+    # digital_modulation_type: see afskmodem.DigitalModulationTypes (both ends must match)
+    # output_device: name or index of the sound card to transmit on (None: system default)
+    def __init__(self, input_device=None, digital_modulation_type=afskmodem.DigitalModulationTypes.afsk1200(), output_device=None):
+        self.receiver = afskmodem.DigitalReceiver(digital_modulation_type, input_device=input_device) # see AFSKmodem README.md for more info on these
+        self.transmitter = afskmodem.DigitalTransmitter(digital_modulation_type, output_device=output_device)
         self.integrity = 1
 
-    def rx(self, timeout=-1): # Listen for and catch a transmission, report bit error rate and return data (bytes)
-        rd, te = self.receiver.rx(timeout)
-        if(len(rd) > 12): # Only record integrity for transmissions longer than 12 bytes (header is 16 bytes)
+    # Listen for and catch a transmission, report bit error rate and return data (bytes).
+    # header_handler is given the packed header (either layout, see parse_header) and returns
+    # the data length to decode, or -1 to drop the frame.
+    def rx(self, timeout=-1, header_handler=None):
+        rd, te = self.receiver.rx(timeout, get_header_length, header_handler)
+        if(len(rd) > 12): # Only record integrity for transmissions longer than 12 bytes (a standard header is 16 bytes)
             self.integrity = 1 - (te / len(rd))
+            PACKET_INTEGRITY.observe(self.integrity)
         return rd
 
     def tx(self, data: bytes): # Transmit raw data (bytes)
@@ -162,6 +157,94 @@ class RadioInterface:
     def get_integrity(self) -> float: # Return integrity of the last received transmission
         return self.integrity
 
+    def est_tx_time(self, data_length: int) -> float: # Estimate airtime in seconds for data_length bytes
+        return self.transmitter.est_tx_time(data_length)
+
+    def channel_busy(self, sense_time=afskmodem.CARRIER_SENSE_TIME) -> bool: # Return True if something is transmitting
+        return self.receiver.channel_busy(sense_time)
+
+################################################################################ Header layouts
+# Packets are saved with the standard 16-byte header: source, dest (4 bytes each), source port,
+# dest port (2 bytes each), flag, age and data length (2 bytes). Compact Packets (see
+# Packet.set_compact) save a shorter one instead:
+#   control byte    0b11110ASP (A: age present, S: source port present, P: dest port present)
+#   data length     unsigned LEB128 varint (1 byte up to 127, 2 up to 16383)
+#   source, dest    4 bytes each
+#   [source port]   2 bytes, left out when COMPACT_DEFAULT_PORT
+#   [dest port]     2 bytes, left out when COMPACT_DEFAULT_PORT
+#   flag            1 byte
+#   [age]           1 byte, left out when 0
+# The flag byte has no bit to spare, so the layout is told by the first byte instead: a standard
+# header starts with the source's first octet, and sources 240-247.x.x.x (reserved, class E) are
+# never sent with one.
+COMPACT_MARKER = 0xF0
+COMPACT_AGE = 0x04
+COMPACT_SOURCE_PORT = 0x02
+COMPACT_DEST_PORT = 0x01
+COMPACT_DEFAULT_PORT = 65535
+#
+# Longest varint data length read (bytes)
+COMPACT_MAX_VARINT = 3
+
+# Does a packed header (or as much of it as is there) use the compact layout?
+def is_compact_header(header) -> bool:
+    return len(header) > 0 and (header[0] & 0xF8) == COMPACT_MARKER
+
+# Get the full length of the packed header at the start of header, from as much of it as is
+# there. Pass this as the receiver's header_length to receive either layout.
+def get_header_length(header) -> int:
+    if(len(header) == 0):
+        return 1
+    if(not is_compact_header(header)):
+        return 16
+    n = 1 # last byte of the varint
+    while(n < len(header) and header[n] & 0x80 and n < COMPACT_MAX_VARINT):
+        n += 1
+    if(n >= len(header)):
+        return n + 1
+    control = header[0]
+    n += 9 # addresses and flag
+    if(control & COMPACT_SOURCE_PORT):
+        n += 2
+    if(control & COMPACT_DEST_PORT):
+        n += 2
+    if(control & COMPACT_AGE):
+        n += 1
+    return n + 1
+
+# Unpack a packed header of either layout. Returns (header length, data length, source (4 bytes),
+# dest (4 bytes), source port, dest port, flag, age).
+def parse_header(header) -> tuple:
+    if(not is_compact_header(header)):
+        return (16, (header[14] << 8) | header[15], header[0:4], header[4:8], (header[8] << 8) | header[9],
+                (header[10] << 8) | header[11], header[12], header[13])
+    control = header[0]
+    dlen = 0
+    n = 1
+    while(True):
+        dlen |= (header[n] & 0x7F) << (7 * (n - 1))
+        n += 1
+        if(header[n - 1] & 0x80 == 0 or n > COMPACT_MAX_VARINT):
+            break
+    source = header[n:n+4]
+    dest = header[n+4:n+8]
+    n += 8
+    sPort = COMPACT_DEFAULT_PORT
+    if(control & COMPACT_SOURCE_PORT):
+        sPort = (header[n] << 8) | header[n+1]
+        n += 2
+    dPort = COMPACT_DEFAULT_PORT
+    if(control & COMPACT_DEST_PORT):
+        dPort = (header[n] << 8) | header[n+1]
+        n += 2
+    flag = header[n]
+    n += 1
+    age = 0
+    if(control & COMPACT_AGE):
+        age = header[n]
+        n += 1
+    return (n, dlen, source, dest, sPort, dPort, flag, age)
+
 ################################################################################ Packet structure and operations
 class Packet:
     def __init__(self, data=b'', source = "0.0.0.0", dest = "0.0.0.0", sPort = 0, dPort = 0):
@@ -190,6 +273,7 @@ class Packet:
         self.age = FormatUtils.int_to_bytes(0, 1)
         self.dlen0 = bytes([FormatUtils.int_to_bytes(len(self.data), 2)[0]])
         self.dlen1 = bytes([FormatUtils.int_to_bytes(len(self.data), 2)[1]])
+        self.compact = False
         self.empty = False
     
     # Return TRUE if this Packet is empty.
@@ -433,19 +517,58 @@ class Packet:
         jf = "".join(sf)
         self.set_flag(jf)
 
+    # Set whether this Packet is saved with the compact header (see Header layouts). Packets
+    # from sources 240-247.x.x.x always are.
+    def set_compact(self, v: bool):
+        self.compact = v
+
+    # Get whether this Packet is saved with the compact header
+    def is_compact(self) -> bool:
+        return self.compact or is_compact_header(self.src0)
+
+    # Get the length of this Packet's header as saved
+    def get_header_length(self) -> int:
+        return len(self.save()) - len(self.data)
+
     # Save the packet to bytes
     def save(self) -> bytes: 
+        if(self.is_compact()):
+            return self.__save_compact()
         p = self.src0 + self.src1 + self.src2 + self.src3
         p += self.dest0 + self.dest1 + self.dest2 + self.dest3
         p += self.sPort0 + self.sPort1 + self.dPort0 + self.dPort1 
         p += self.flag + self.age + self.dlen0 + self.dlen1
         p += self.data
         return p
+
+    def __save_compact(self) -> bytes:
+        control = COMPACT_MARKER
+        ports = b''
+        if(self.get_source_port() != COMPACT_DEFAULT_PORT):
+            control |= COMPACT_SOURCE_PORT
+            ports += self.sPort0 + self.sPort1
+        if(self.get_dest_port() != COMPACT_DEFAULT_PORT):
+            control |= COMPACT_DEST_PORT
+            ports += self.dPort0 + self.dPort1
+        age = b''
+        if(self.get_age() != 0):
+            control |= COMPACT_AGE
+            age = self.age
+        p = bytes([control]) + FormatUtils.int_to_varint(self.get_length())
+        p += self.src0 + self.src1 + self.src2 + self.src3
+        p += self.dest0 + self.dest1 + self.dest2 + self.dest3
+        p += ports + self.flag + age
+        p += self.data
+        return p
     
-    # Load a packet from bytes
+    # Load a packet from bytes (either header layout)
     def load(self, bdata: bytes): 
+        if(is_compact_header(bdata)):
+            self.__load_compact(bdata)
+            return
         try:
             self.empty = False
+            self.compact = False
             self.src0 = bdata[0:1]
             self.src1 = bdata[1:2]
             self.src2 = bdata[2:3]
@@ -465,129 +588,602 @@ class Packet:
             dLen = FormatUtils.bytes_to_int(self.dlen0 + self.dlen1)
             self.data = bdata[16:16+dLen]
         except Exception as e:
-            self.empty = True
-            self.src0 = FormatUtils.int_to_bytes(0, 1)
-            self.src1 = FormatUtils.int_to_bytes(0, 1)
-            self.src2 = FormatUtils.int_to_bytes(0, 1)
-            self.src3 = FormatUtils.int_to_bytes(0, 1)
-            self.dest0 = FormatUtils.int_to_bytes(0, 1)
-            self.dest1 = FormatUtils.int_to_bytes(0, 1)
-            self.dest2 = FormatUtils.int_to_bytes(0, 1)
-            self.dest3 = FormatUtils.int_to_bytes(0, 1)
-            self.sPort0 = FormatUtils.int_to_bytes(0, 1)
-            self.sPort1 = FormatUtils.int_to_bytes(0, 1)
-            self.dPort0 = FormatUtils.int_to_bytes(0, 1)
-            self.dPort1 = FormatUtils.int_to_bytes(0, 1)
-            self.flag = FormatUtils.int_to_bytes(0, 1)
-            self.age = FormatUtils.int_to_bytes(0, 1)
-            self.dlen0 = FormatUtils.int_to_bytes(0, 1)
-            self.dlen1 = FormatUtils.int_to_bytes(0, 1)
-    
-    # Write bytes to build a Packet
-    def __write_raw(self, src0, src1, src2, src3, 
-                    dest0, dest1, dest2, dest3,
-                    sPort0, sPort1, dPort0, dPort1,
-                    flag, age, dlen0, dlen1, data):
-        self.src0 = src0
-        self.src1 = src1
-        self.src2 = src2
-        self.src3 = src3
-        self.dest0 = dest0
-        self.dest1 = dest1
-        self.dest2 = dest2
-        self.dest3 = dest3
-        self.sPort0 = sPort0
-        self.sPort1 = sPort1
-        self.dPort0 = dPort0
-        self.dPort1 = dPort1
-        self.flag = flag
-        self.age = age
-        self.dlen0 = dlen0
-        self.dlen1 = dlen1
-        self.data = data
+            self.__clear()
+
+    def __load_compact(self, bdata: bytes):
+        try:
+            hlen, dLen, source, dest, sPort, dPort, flag, age = parse_header(bdata)
+            self.empty = False
+            self.compact = True
+            self.src0, self.src1, self.src2, self.src3 = [bytes([b]) for b in source]
+            self.dest0, self.dest1, self.dest2, self.dest3 = [bytes([b]) for b in dest]
+            self.sPort0, self.sPort1 = [bytes([b]) for b in FormatUtils.int_to_bytes(sPort, 2)]
+            self.dPort0, self.dPort1 = [bytes([b]) for b in FormatUtils.int_to_bytes(dPort, 2)]
+            self.flag = bytes([flag])
+            self.age = bytes([age])
+            self.dlen0, self.dlen1 = [bytes([b]) for b in FormatUtils.int_to_bytes(dLen, 2)]
+            self.data = bytes(bdata[hlen:hlen+dLen])
+        except Exception as e:
+            self.__clear()
+
+    # Reset every field after a failed load
+    def __clear(self):
+        self.empty = True
+        self.compact = False
+        self.src0 = FormatUtils.int_to_bytes(0, 1)
+        self.src1 = FormatUtils.int_to_bytes(0, 1)
+        self.src2 = FormatUtils.int_to_bytes(0, 1)
+        self.src3 = FormatUtils.int_to_bytes(0, 1)
+        self.dest0 = FormatUtils.int_to_bytes(0, 1)
+        self.dest1 = FormatUtils.int_to_bytes(0, 1)
+        self.dest2 = FormatUtils.int_to_bytes(0, 1)
+        self.dest3 = FormatUtils.int_to_bytes(0, 1)
+        self.sPort0 = FormatUtils.int_to_bytes(0, 1)
+        self.sPort1 = FormatUtils.int_to_bytes(0, 1)
+        self.dPort0 = FormatUtils.int_to_bytes(0, 1)
+        self.dPort1 = FormatUtils.int_to_bytes(0, 1)
+        self.flag = FormatUtils.int_to_bytes(0, 1)
+        self.age = FormatUtils.int_to_bytes(0, 1)
+        self.dlen0 = FormatUtils.int_to_bytes(0, 1)
+        self.dlen1 = FormatUtils.int_to_bytes(0, 1)
     
+    # Lazily iterate over the packets stored in this GROUP container. Yields a
+    # PacketView over the container's buffer for each inner packet, skipping
+    # (without building anything) those not matching the optional dest/dPort.
+    def iter_grouped_packets(self, dest=None, dPort=None):
+        if(not self.is_group_flag()):
+            return
+        pd = memoryview(self.data)
+        if(dest is not None):
+            packed_dest = bytes(FormatUtils.parse_address(dest))
+        n = 0
+        while(n < len(pd)):
+            hLen = get_header_length(pd[n:])
+            if(n + hLen > len(pd)): # do not overflow
+                break
+            header = parse_header(pd[n:n+hLen])
+            dLen = header[1]
+            if(n+hLen+dLen > len(pd)):
+                break
+            if(dest is not None and header[3] != packed_dest):
+                n = n + hLen + dLen
+                continue
+            if(dPort is not None and header[5] != int(dPort)):
+                n = n + hLen + dLen
+                continue
+            yield PacketView(pd, n, header)
+            n = n + hLen + dLen # next packet
+
     # Extract grouped packets from their container
     def get_grouped_packets(self):
         try:
-            if(not self.is_group_flag()):
-                return []
-            op = []
-            n = 0
-            pd = self.get_data()
-            while(n < len(pd) - 16):
-                log(0, "Reading grouped packet at index " + str(n))
-                gp = Packet() # instantiate a packet and read into it
-                src0 = pd[n:n+1]
-                src1 = pd[n+1:n+2]
-                src2 = pd[n+2:n+3]
-                src3 = pd[n+3:n+4]
-                dest0 = pd[n+4:n+5]
-                dest1 = pd[n+5:n+6]
-                dest2 = pd[n+6:n+7]
-                dest3 = pd[n+7:n+8]
-                sPort0 = pd[n+8:n+9]
-                sPort1 = pd[n+9:n+10]
-                dPort0 = pd[n+10:n+11]
-                dPort1 = pd[n+11:n+12]
-                flag = pd[n+12:n+13]
-                age = pd[n+13:n+14]
-                dlen0 = pd[n+14:n+15]
-                dlen1 = pd[n+15:n+16]
-                dLen = FormatUtils.bytes_to_int(dlen0 + dlen1)
-                if(n+16+dLen > len(pd)): # do not overflow
-                    break
-                data = pd[n+16:n+16+dLen]
-                gp.__write_raw(src0, src1, src2, src3, # write to packet
-                                dest0, dest1, dest2, dest3,
-                                sPort0, sPort1, dPort0, dPort1,
-                                flag, age, dlen0, dlen1, data)
-                op.append(gp) # store packet in array
-                n = n + 16 + dLen # next packet
-            return(op)
+            return [v.to_packet() for v in self.iter_grouped_packets()]
         except:
             log(1, "Failed to extract grouped packets.")
             return []
 
+################################################################################ Grouped packet views
+class PacketView:
+    # Read-only view of a packet held inside a GROUP container, given its parsed
+    # header (see parse_header). Nothing is copied until get_data() or to_packet() is called.
+    def __init__(self, buf: memoryview, offset: int, header: tuple):
+        self.buf = buf
+        self.offset = offset
+        self.hlen, self.dlen, self.source, self.dest, self.sPort, self.dPort, self.flag, self.age = header
+
+    # Get the packed header of this view
+    def get_header(self) -> memoryview:
+        return self.buf[self.offset:self.offset+self.hlen]
+
+    # Get the source address of this view
+    def get_source(self) -> str:
+        return FormatUtils.make_address(list(self.source))
+
+    # Get the destination address of this view
+    def get_dest(self) -> str:
+        return FormatUtils.make_address(list(self.dest))
+
+    # Get the source port of this view
+    def get_source_port(self) -> int:
+        return self.sPort
+
+    # Get the destination port of this view
+    def get_dest_port(self) -> int:
+        return self.dPort
+
+    # Get the flag byte of this view
+    def get_flag(self) -> str:
+        return FormatUtils.int_to_bits(self.flag)
+
+    # Get the age of this view
+    def get_age(self) -> int:
+        return self.age
+
+    # Get the data length of this view
+    def get_length(self) -> int:
+        return self.dlen
+
+    # Get the GROUP flag of this view
+    def is_group_flag(self) -> bool:
+        return (self.flag & 0x80) != 0
+
+    # Get the data payload of this view without copying it
+    def get_data_view(self) -> memoryview:
+        n = self.offset + self.hlen
+        return self.buf[n:n+self.dlen]
+
+    # Get the data payload of this view
+    def get_data(self) -> bytes:
+        return self.get_data_view().tobytes()
+
+    # Build a full Packet from this view
+    def to_packet(self) -> Packet:
+        p = Packet()
+        p.load(self.buf[self.offset:self.offset+self.hlen+self.dlen].tobytes())
+        return p
+
 ################################################################################ High-level operations
+# Carrier sense defaults (see NetworkInterface.set_carrier_sense)
+# Seconds of input sampled before each transmission
+CSMA_SENSE_TIME = afskmodem.CARRIER_SENSE_TIME
+#
+# Backoff slot in seconds. After the nth busy sense the interface waits a random 0 to 2^n slots.
+CSMA_SLOT_TIME = 0.25
+#
+# Largest backoff exponent (n above)
+CSMA_MAX_BACKOFF = 5
+#
+# Most seconds to wait for a clear channel before transmitting anyway (disabled when not positive)
+CSMA_MAX_WAIT = 30
+
 class NetworkInterface:
-    def __init__(self, address: str, port: int):
+    # input_device, output_device: the radio's sound card (see RadioInterface)
+    def __init__(self, address: str, port: int, digital_modulation_type=afskmodem.DigitalModulationTypes.afsk1200(),
+                 input_device=None, output_device=None):
         self.address = address
         self.port = port
-        self.ri = RadioInterface()
-        log(0, "Instantiated a NetworkInterface on socket address " + self.address + ":" + str(self.port) + ".")
+        self.packed_address = bytes(FormatUtils.parse_address(address))
+        self.ri = RadioInterface(input_device, digital_modulation_type, output_device)
+        # Subscriptions, indexed on the packed destination: dest+port (6 bytes), dest with
+        # any port (4 bytes), any dest on a port (2 bytes) or anything (empty key).
+        self.subscriptions = {}
+        self.subscription_keys = {}
+        self.next_subscription_id = 0
+        self.stage_hook = None
+        self.csma = False
+        self.csma_sense_time = CSMA_SENSE_TIME
+        self.csma_slot_time = CSMA_SLOT_TIME
+        self.csma_max_backoff = CSMA_MAX_BACKOFF
+        self.csma_max_wait = CSMA_MAX_WAIT
+        self.csma_sends = 0
+        self.csma_deferrals = 0
+        self.csma_forced = 0
+        self.csma_wait_seconds = 0.0
+        self.compact_headers = False
+        log(0, "Instantiated a NetworkInterface on socket address %s:%s.", self.address, self.port)
     
     # Return a Packet with the specified parameters
     def make_packet(self, data: bytes, dest: str, destPort: int) -> Packet:
-        return Packet(data, self.address, dest, self.port, destPort)
+        p = Packet(data, self.address, dest, self.port, destPort)
+        p.set_compact(self.compact_headers)
+        return p
+
+    # Make Packets from make_packet() with the compact header (see Header layouts). Every
+    # interface receives both layouts; older receivers only understand the standard one.
+    def set_compact_headers(self, v: bool):
+        self.compact_headers = v
     
-    # Send a Packet
-    def send_packet(self, p: Packet):
-        log(0, "Sending a Packet addressed to " + p.get_dest() + ":" + str(p.get_dest_port()) + ".")
+    # Send a Packet, first waiting for a clear channel if carrier sense is on. Returns the
+    # seconds spent waiting (0 without carrier sense).
+    def send_packet(self, p: Packet) -> float:
+        waited = 0
+        if(self.csma):
+            waited = self.wait_for_channel()
+        log(0, "Sending a Packet addressed to %s:%d.", p.get_dest(), p.get_dest_port())
         self.ri.tx(p.save())
+        PACKETS_SENT.inc()
+        return waited
+
+    # Listen before talking: sense the channel before each send_packet() and, while it is busy,
+    # back off for a random 0 to 2^n slots (n: busy senses so far, up to max_backoff) so that
+    # stations waiting on the same transmission don't all key up when it ends. After max_wait
+    # seconds (disabled when not positive) the Packet is sent anyway.
+    def set_carrier_sense(self, enabled=True, sense_time=CSMA_SENSE_TIME, slot_time=CSMA_SLOT_TIME,
+                          max_backoff=CSMA_MAX_BACKOFF, max_wait=CSMA_MAX_WAIT):
+        self.csma = enabled
+        self.csma_sense_time = sense_time
+        self.csma_slot_time = slot_time
+        self.csma_max_backoff = max_backoff
+        self.csma_max_wait = max_wait
+
+    # Wait until the channel is clear (see set_carrier_sense). Returns the seconds waited. If the
+    # input can't be read, the channel is taken to be clear rather than holding up the send.
+    def wait_for_channel(self) -> float:
+        start_time = monotonic()
+        busy_senses = 0
+        while(True):
+            try:
+                busy = self.ri.channel_busy(self.csma_sense_time)
+            except Exception as e:
+                log(2, "Carrier sense failed: %s. Transmitting as if the channel were clear.", e)
+                busy = False
+            if(not busy):
+                break
+            busy_senses += 1
+            self.csma_deferrals += 1
+            CSMA_DEFERRALS.inc()
+            waited = monotonic() - start_time
+            if(self.csma_max_wait > 0 and waited >= self.csma_max_wait):
+                self.csma_forced += 1
+                CSMA_FORCED.inc()
+                log(1, "Channel busy for %.1f s, transmitting anyway.", waited)
+                break
+            backoff = random.uniform(0, self.csma_slot_time * 2 ** min(busy_senses, self.csma_max_backoff))
+            if(self.csma_max_wait > 0):
+                backoff = min(backoff, self.csma_max_wait - waited)
+            log(0, "Channel busy, backing off for %.2f s.", backoff)
+            sleep(backoff)
+        waited = monotonic() - start_time
+        self.csma_sends += 1
+        self.csma_wait_seconds += waited
+        CSMA_WAIT_SECONDS.inc(waited)
+        return waited
+
+    # Get the carrier sense counters: Packets sent with it, busy senses, Packets sent after
+    # waiting the longest allowed, and total seconds spent waiting (including sensing)
+    def get_csma_stats(self) -> dict:
+        return {"sends": self.csma_sends,
+                "deferrals": self.csma_deferrals,
+                "forced": self.csma_forced,
+                "wait_seconds": self.csma_wait_seconds}
     
+    # Estimate the airtime of a Packet in seconds
+    def est_tx_time(self, p: Packet) -> float:
+        return self.ri.est_tx_time(p.get_header_length() + p.get_length())
+
+    # Call hook(stage, seconds) after each stage of receiving a Packet: the receiver's stages
+    # (see afskmodem.DigitalReceiver), then packet_load and, when dispatching, dispatch
+    def set_stage_hook(self, hook):
+        self.stage_hook = hook
+        self.ri.receiver.stage_hook = hook
+
+    # Accept any header and decode exactly the data length it announces
+    def __accept_any_header(self, header: bytes) -> int:
+        return parse_header(header)[1]
+
+    # Accept only headers addressed to this interface, comparing the packed bytes
+    def __accept_own_header(self, header: bytes) -> int:
+        hlen, dlen, source, dest, sPort, dPort, flag, age = parse_header(header)
+        if(dest != self.packed_address or dPort != int(self.port)):
+            return -1
+        return dlen
+
     # Listen for and return any Packet
     def listen_for_any_packet(self, timeout=-1) -> Packet: 
         log(0, "Listening for any Packet...")
         while True:
-            rd = self.ri.rx(timeout)
+            rd = self.ri.rx(timeout, self.__accept_any_header)
             if(rd != b''):
+                PACKETS_RECEIVED.inc()
+                timer = afskmodem.StageTimer(self.stage_hook)
                 p = Packet()
                 p.load(rd)
-                log(0, "Caught a Packet addressed to " + p.get_dest() + ":" + str(p.get_dest_port()) + ".")
+                timer.lap("packet_load")
+                log(0, "Caught a Packet addressed to %s:%d.", p.get_dest(), p.get_dest_port())
                 return p
     
     # Listen for and return a Packet addressed to this interface
     def listen_for_packet(self, timeout=-1) -> Packet: 
-        log(0, "Listening for a Packet addressed to this NetworkInterface (" + self.address + ":" + str(self.port) + ")...")
+        log(0, "Listening for a Packet addressed to this NetworkInterface (%s:%s)...", self.address, self.port)
         while True:
-            rd = self.ri.rx(timeout)
+            rd = self.ri.rx(timeout, self.__accept_own_header)
             if(rd != b''):
+                PACKETS_RECEIVED.inc()
+                timer = afskmodem.StageTimer(self.stage_hook)
                 p = Packet()
                 p.load(rd)
-                if(p.get_dest() == self.address and int(p.get_dest_port()) == int(self.port)):
-                    log(0, "Received a Packet addressed to this NetworkInterface (" + self.address + ":" + str(self.port) + ").")
-                    return p
+                timer.lap("packet_load")
+                log(0, "Received a Packet addressed to this NetworkInterface (%s:%s).", self.address, self.port)
+                return p
+
+    # Make the subscription index key for an address and port ("*" matches any)
+    def __make_subscription_key(self, address, port) -> bytes:
+        key = b''
+        if(address != "*"):
+            key += bytes(FormatUtils.parse_address(address))
+        if(port != "*"):
+            key += FormatUtils.int_to_bytes(int(port), 2)
+        return key
+
+    # Call callback(Packet) for every Packet (or grouped Packet) addressed to address:port.
+    # Either may be "*" to match anything. Returns an id to pass to unsubscribe().
+    def subscribe(self, address: str, port, callback) -> int:
+        key = self.__make_subscription_key(address, port)
+        sid = self.next_subscription_id
+        self.next_subscription_id += 1
+        self.subscriptions.setdefault(key, {})[sid] = callback
+        self.subscription_keys[sid] = key
+        log(0, "Subscribed to Packets addressed to %s:%s.", address, port)
+        return sid
+
+    # Remove a subscription made with subscribe()
+    def unsubscribe(self, sid: int):
+        key = self.subscription_keys.pop(sid, None)
+        if(key is None):
+            return
+        del self.subscriptions[key][sid]
+        if(len(self.subscriptions[key]) == 0):
+            del self.subscriptions[key]
+
+    # Get the callbacks subscribed to a packed header
+    def __get_subscribers(self, header) -> list:
+        hlen, dlen, source, dest, sPort, dPort, flag, age = parse_header(header)
+        dest = bytes(dest)
+        port = FormatUtils.int_to_bytes(dPort, 2)
+        subs = []
+        for key in (dest + port, dest, port, b''):
+            if(key in self.subscriptions):
+                subs.extend(self.subscriptions[key].values())
+        return subs
+
+    # Accept headers with a subscriber, and GROUP containers which may hold some
+    def __accept_subscribed_header(self, header: bytes) -> int:
+        hlen, dlen, source, dest, sPort, dPort, flag, age = parse_header(header)
+        if(flag & 0x80 == 0 and len(self.__get_subscribers(header)) == 0):
+            return -1
+        return dlen
+
+    # Deliver a Packet and the Packets grouped inside it to their subscribers.
+    # Returns the number of callbacks made.
+    def dispatch(self, p: Packet) -> int:
+        delivered = 0
+        raw = p.save()
+        for callback in self.__get_subscribers(raw[0:len(raw) - p.get_length()]):
+            callback(p)
+            delivered += 1
+        for v in p.iter_grouped_packets():
+            subs = self.__get_subscribers(v.get_header())
+            if(len(subs) == 0):
+                continue
+            gp = v.to_packet()
+            for callback in subs:
+                callback(gp)
+                delivered += 1
+        PACKETS_DISPATCHED.inc(delivered)
+        return delivered
+
+    # Listen for one transmission and dispatch it to subscribers. Returns the number of callbacks made.
+    def listen_and_dispatch(self, timeout=-1) -> int:
+        rd = self.ri.rx(timeout, self.__accept_subscribed_header)
+        if(rd == b''):
+            return 0
+        PACKETS_RECEIVED.inc()
+        timer = afskmodem.StageTimer(self.stage_hook)
+        p = Packet()
+        p.load(rd)
+        timer.lap("packet_load")
+        delivered = self.dispatch(p)
+        timer.lap("dispatch")
+        return delivered
+
+    # Dispatch received Packets to subscribers until interrupted
+    def serve_forever(self):
+        log(0, "Dispatching Packets to %d subscriptions...", len(self.subscription_keys))
+        while True:
+            self.listen_and_dispatch()
     
     # Get the integrity of the most recently received Packet
     def get_integrity(self) -> float: 
         return self.ri.get_integrity()
+
+################################################################################ Store-and-forward repeater
+class Repeater:
+    def __init__(self, ni: NetworkInterface, max_hops=4, cache_size=256, cache_time=300,
+                 min_holdoff=0.5, max_holdoff=3.0):
+        self.ni = ni
+        self.max_hops = max_hops
+        self.cache_size = cache_size # Most frames remembered for duplicate suppression
+        self.cache_time = cache_time # Seconds a frame is remembered for
+        self.min_holdoff = min_holdoff # Random delay (seconds) before retransmitting
+        self.max_holdoff = max_holdoff
+        self.seen = OrderedDict() # frame hash -> time last seen, oldest first
+        self.tx_queue = queue.Queue()
+        self.relayed = 0
+        self.dropped_duplicate = 0
+        self.dropped_ttl = 0
+        self.tx_thread = threading.Thread(target=self.__transmit_loop, daemon=True)
+        self.tx_thread.start()
+        log(0, "Instantiated a Repeater (max hops: %d).", self.max_hops)
+
+    # Hash a frame's header fields and payload, whichever layout it came in. The age is left
+    # out since every hop changes it.
+    def __frame_hash(self, p: Packet) -> bytes:
+        fields = p.src0 + p.src1 + p.src2 + p.src3 + p.dest0 + p.dest1 + p.dest2 + p.dest3
+        fields += p.sPort0 + p.sPort1 + p.dPort0 + p.dPort1 + p.flag
+        return hashlib.blake2b(fields + p.get_data(), digest_size=16).digest()
+
+    # Record a frame hash, returning True if it was already seen within the time window
+    def __check_seen(self, key: bytes) -> bool:
+        now = monotonic()
+        while(len(self.seen) > 0):
+            oldest_key, oldest_time = next(iter(self.seen.items()))
+            if(now - oldest_time < self.cache_time and len(self.seen) < self.cache_size):
+                break
+            del self.seen[oldest_key]
+        duplicate = key in self.seen
+        self.seen[key] = now
+        self.seen.move_to_end(key)
+        return duplicate
+
+    # Transmit queued Packets, each after a random holdoff so repeaters in range don't collide
+    def __transmit_loop(self):
+        while True:
+            p = self.tx_queue.get()
+            sleep(random.uniform(self.min_holdoff, self.max_holdoff))
+            try:
+                self.ni.send_packet(p)
+                self.relayed += 1
+            except Exception as e:
+                log(2, "Repeater - failed to relay a Packet: %s.", e)
+
+    # Decide whether to relay a received Packet, and queue it if so. Returns True if queued.
+    def handle_packet(self, p: Packet) -> bool:
+        if(p.is_empty()):
+            return False
+        if(self.__check_seen(self.__frame_hash(p))):
+            self.dropped_duplicate += 1
+            log(0, "Repeater - dropped a duplicate Packet.")
+            return False
+        if(p.get_age() >= self.max_hops):
+            self.dropped_ttl += 1
+            log(0, "Repeater - dropped a Packet at its hop limit.")
+            return False
+        p.increment_age()
+        self.tx_queue.put(p)
+        log(0, "Repeater - queued a Packet addressed to %s:%d (age %d).", p.get_dest(), p.get_dest_port(), p.get_age())
+        return True
+
+    # Get the repeater's counters
+    def get_stats(self) -> dict:
+        return {"relayed": self.relayed,
+                "dropped_duplicate": self.dropped_duplicate,
+                "dropped_ttl": self.dropped_ttl,
+                "queued": self.tx_queue.qsize()}
+
+    # Receive and relay Packets until interrupted
+    def serve_forever(self):
+        while True:
+            self.handle_packet(self.ni.listen_for_any_packet())
+
+################################################################################ Multi-device receive host
+# Seconds a capture thread waits for a burst before checking whether it should stop
+HOST_CAPTURE_TIMEOUT = 1
+#
+# Seconds to wait before reopening a device whose capture failed
+HOST_RETRY_TIME = 5
+
+# Receivers used by decode_burst, one per (modulation type, end threshold) in each worker process
+host_receivers = {}
+
+# Demodulate a burst captured by a ReceiverHost. Runs in a worker process. Returns the
+# frame and its corrected bit count; the frame is b'' if it could not be decoded or, when
+# packed_dest is given, was not addressed to packed_dest:port.
+def decode_burst(modulation_type: str, amp_end_threshold: int, wav_data: bytes, packed_dest=None, port=0):
+    key = (modulation_type, amp_end_threshold)
+    if(key not in host_receivers):
+        host_receivers[key] = afskmodem.DigitalReceiver(modulation_type, amp_end_threshold=amp_end_threshold)
+    def accept_header(header: bytes) -> int:
+        hlen, dlen, source, dest, sPort, dPort, flag, age = parse_header(header)
+        if(packed_dest is not None and (dest != packed_dest or dPort != port)):
+            return -1
+        return dlen
+    return host_receivers[key].demodulate(wav_data, get_header_length, accept_header)
+
+class ReceiverHost: # Receives on several sound cards at once and merges their Packets
+    # devices: input device names or indices, one radio each. If address is given, only Packets
+    # addressed to address:port are kept. workers: decoding processes (default: one per CPU).
+    def __init__(self, devices: list, address=None, port=65535, workers=None,
+                 digital_modulation_type=afskmodem.DigitalModulationTypes.afsk1200()):
+        self.receivers = {} # device -> DigitalReceiver
+        self.stats = {}
+        for d in devices:
+            self.receivers[str(d)] = afskmodem.DigitalReceiver(digital_modulation_type, input_device=d)
+            self.stats[str(d)] = {"bursts": 0, "packets": 0, "dropped": 0, "errors": 0,
+                                  "decode_seconds": 0.0, "integrity": 1}
+        self.packed_address = None if address is None else bytes(FormatUtils.parse_address(address))
+        self.port = int(port)
+        # Demodulation is pure Python, so it is spread over processes rather than threads.
+        # Workers are started on the first burst, from a capture thread, so they are never
+        # forked from this (threaded) process: a fork server is used where there is one.
+        # Scripts using a ReceiverHost need a __main__ guard, since workers import them.
+        # (Imported here so that the rest of the module doesn't pay for multiprocessing.)
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        if("forkserver" in multiprocessing.get_all_start_methods()):
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = multiprocessing.get_context("spawn")
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        self.packets = queue.Queue() # (device, Packet, integrity)
+        self.stop_event = threading.Event()
+        self.threads = []
+        log(0, "Instantiated a ReceiverHost on %d devices.", len(self.receivers))
+
+    # Start one capture thread per device
+    def start(self):
+        self.stop_event.clear()
+        for device in self.receivers:
+            t = threading.Thread(target=self.__capture_loop, args=(device,), name="capture " + device, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    # Stop capturing, close the devices and shut the decoding processes down
+    def stop(self):
+        self.stop_event.set()
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+    # Capture bursts from a device and hand them to the decoding processes
+    def __capture_loop(self, device: str):
+        receiver = self.receivers[device]
+        stats = self.stats[device]
+        while(not self.stop_event.is_set()):
+            try:
+                if(receiver.stream is None):
+                    receiver.open()
+                wav_data = receiver.record(HOST_CAPTURE_TIMEOUT)
+            except Exception as e:
+                stats["errors"] += 1
+                log(2, "ReceiverHost - capture failed on %s: %s.", device, e)
+                receiver.close()
+                self.stop_event.wait(HOST_RETRY_TIME)
+                continue
+            if(wav_data == b''):
+                continue
+            stats["bursts"] += 1
+            future = self.pool.submit(decode_burst, receiver.digital_modulation_type, receiver.amp_end_threshold,
+                                      wav_data, self.packed_address, self.port)
+            future.add_done_callback(lambda f, started=monotonic(): self.__finish_burst(device, f, started))
+        receiver.close()
+
+    # Turn a decoded burst into a Packet tagged with its device
+    def __finish_burst(self, device: str, future, started: float):
+        stats = self.stats[device]
+        stats["decode_seconds"] += monotonic() - started
+        if(future.cancelled()):
+            return
+        try:
+            rd, te = future.result()
+        except Exception as e:
+            stats["dropped"] += 1
+            log(2, "ReceiverHost - decoding failed on %s: %s.", device, e)
+            return
+        if(rd == b''):
+            stats["dropped"] += 1
+            return
+        integrity = 1 - (te / len(rd))
+        p = Packet()
+        p.load(rd)
+        stats["packets"] += 1
+        stats["integrity"] = integrity
+        PACKETS_RECEIVED.inc()
+        PACKET_INTEGRITY.observe(integrity)
+        log(0, "Caught a Packet addressed to %s:%d on %s.", p.get_dest(), p.get_dest_port(), device)
+        self.packets.put((device, p, integrity))
+
+    # Get the next received (device, Packet, integrity), or None on timeout (seconds, disabled by default)
+    def get(self, timeout=-1):
+        try:
+            return self.packets.get(timeout=None if timeout < 0 else timeout)
+        except queue.Empty:
+            return None
+
+    # Get each device's counters: bursts captured, packets decoded, bursts dropped (undecodable
+    # or filtered), capture errors, total decode latency and the last packet's integrity
+    def get_stats(self) -> dict:
+        out = {}
+        for device, stats in self.stats.items():
+            out[device] = dict(stats)
+        return out
@@ -6,10 +6,13 @@ x----------------------------------------------x
 """
 import wave
 import struct
-import pyaudio
-from datetime import datetime
-import os
+import threading
+import math
 from time import sleep
+from itertools import chain, islice
+from time import perf_counter
+import metrics
+import mercurylog
 
 ################################################################################ PROGRAM DEFAULTS
 
@@ -18,25 +21,46 @@ from time import sleep
 # Training sequence time in seconds (0.5-1.0, Default 0.6)
 TRAINING_SEQUENCE_TIME = 0.8
 #
-# Chunk amplitude at which decoding starts (0-32768, Default 18000 [-5.2 dBfs])
+# Chunk amplitude at which decoding starts, without ADAPTIVE_SQUELCH (0-32768, Default 18000 [-5.2 dBfs])
 AMPLITUDE_START_THRESHOLD = 18000
 #
-# Chunk amplitude at which decoding stops (0-32768, Default 14000 [-7.4 dBfs])
+# Chunk amplitude at which decoding stops (0-32768, Default 14000 [-7.4 dBfs]) - With AUTOMATIC_GAIN, of the normalized burst
 AMPLITUDE_END_THRESHOLD = 14000
 #
-# Amplifier function deadzone (0-32768, Default 128 [-48.2 dBfs])
+# Amplifier function deadzone (0-32768, Default 128 [-48.2 dBfs]) - With AUTOMATIC_GAIN, of the normalized burst
 AMPLIFIER_DEADZONE = 128
 #
+# Follow the input's noise floor and open the squelch relative to it (True, Default) instead of at AMPLITUDE_START_THRESHOLD
+ADAPTIVE_SQUELCH = True
+#
+# With ADAPTIVE_SQUELCH, the squelch opens this many times above the noise floor (Default 4.0 [+12 dB])
+SQUELCH_OPEN_RATIO = 4.0
+#
+# ...and closes again below this many times the noise floor (Default 2.0 [+6 dB])
+SQUELCH_CLOSE_RATIO = 2.0
+#
+# Lowest chunk amplitude the adaptive squelch opens at, however quiet the input (0-32768, Default 1000 [-30.3 dBfs])
+SQUELCH_MIN_LEVEL = 1000
+#
+# Normalize every burst to AMPLITUDE_REFERENCE before demodulating it (True, Default), so the receive level doesn't matter
+AUTOMATIC_GAIN = True
+#
 # Frames per buffer for audio input (1024-4096, Default 2048 [0.043s]) - Smaller blocks increase CPU usage but decrease latency
 INPUT_FRAMES_PER_BLOCK = 2048
+#
+# Demodulate bursts while they are still being recorded (True, Default) instead of after the carrier drops
+STREAMING_DEMODULATION = True
+#
+# Seconds of input sampled to decide whether the channel is clear before transmitting (Default 0.1)
+CARRIER_SENSE_TIME = 0.1
 
 # SYSTEM PARAMETERS: DO NOT CHANGE THESE!
 #
 # How many samples per second we are recording (DO NOT CHANGE, sound card resamples if needed)
 SAMPLE_RATE = 48000
 #
-# Wav format (DO NOT CHANGE, sound card handles format conversion if needed)
-FORMAT = pyaudio.paInt16
+# Bytes per sample, signed 16-bit (DO NOT CHANGE, sound card handles format conversion if needed)
+SAMPLE_WIDTH = 2
 #
 # Input+output channels (DO NOT CHANGE, sound card handles stereo conversion if needed)
 CHANNELS = 1
@@ -47,52 +71,79 @@ CLOCK_SCAN_WIDTH = 2 * INPUT_FRAMES_PER_BLOCK
 #
 # Directory where ideal waves are stored
 IDEAL_WAVES_DIR = "data/ideal_waves/"
+#
+# Chunk amplitude bursts are normalized to (a sine just below full scale)
+AMPLITUDE_REFERENCE = 20000
+#
+# How far the noise floor estimate moves towards each quieter / louder block (0-1). It falls quickly
+# and rises slowly, so a noisier channel is followed within a few seconds. During a burst it rises
+# far slower still: enough for a squelch opened by a step up in noise to close within half a
+# minute, too little to cut off a long transmission.
+NOISE_FLOOR_FALL = 0.5
+NOISE_FLOOR_RISE = 0.02
+NOISE_FLOOR_BURST_RISE = 0.001
 
 ################################################################################ LOGGING
-def get_date_and_time(): # Long date and time for logging
-        now = datetime.now()
-        return now.strftime('%Y-%m-%d %H:%M:%S')
-
 # Logging level (0: INFO, 1: WARN (recommended), 2: ERROR, 3: NONE)
 LOG_LEVEL = 0
 #
-# Should the log output to the console?
-LOG_TO_CONSOLE = True
-#
-# Should the log output to a log file?
-LOG_TO_FILE = False
-#
-# Where to generate logfile if need be
-LOG_PATH = "afskmodem.log"
-#
-# How the log identifies which module is logging.
+# How the log identifies which module is logging. (Log output is configured in mercurylog.py)
 LOG_PREFIX = "(AFSKmodem)"
 
-# Initialize log file if needed
-if(LOG_TO_FILE):
-    try:
-        os.remove(LOG_PATH)
-    except:
-        pass
-    with open(LOG_PATH, "w") as f:
-        f.write(get_date_and_time() + " [INFO] " + LOG_PREFIX + " Logging initialized.\n")
-
-def log(level: int, data: str):
-    if(level >= LOG_LEVEL):
-        output = get_date_and_time()
-        if(level == 0):
-            output += " [INFO] "
-        elif(level == 1):
-            output += " [WARN] "
-        else:
-            output += " [ERR!] "
-        output += LOG_PREFIX + " "
-        output += data
-        if(LOG_TO_FILE):
-            with open(LOG_PATH, "a") as f:
-                f.write(output + "\n")
-        if(LOG_TO_CONSOLE):
-            print(output)
+log = mercurylog.get_logger(LOG_PREFIX, LOG_LEVEL)
+
+################################################################################ METRICS
+RX_BURSTS = metrics.counter("afskmodem_rx_bursts_total", "Bursts recorded by the receiver")
+RX_TIMEOUTS = metrics.counter("afskmodem_rx_timeouts_total", "Receive calls that timed out")
+RX_SYNC_FAILURES = metrics.counter("afskmodem_rx_sync_failures_total", "Bursts whose clock or training block could not be recovered")
+RX_REJECTED = metrics.counter("afskmodem_rx_rejected_total", "Frames dropped by the header filter")
+RX_BYTES = metrics.counter("afskmodem_rx_bytes_total", "Bytes decoded by the receiver")
+RX_ECC_CORRECTIONS = metrics.counter("afskmodem_rx_ecc_corrections_total", "Bit errors corrected by Hamming ECC")
+RX_DECODE_SECONDS = metrics.histogram("afskmodem_rx_decode_seconds", "Time from the end of a burst's audio to its decoded data")
+TX_FRAMES = metrics.counter("afskmodem_tx_frames_total", "Frames transmitted")
+TX_BYTES = metrics.counter("afskmodem_tx_bytes_total", "Bytes transmitted")
+TX_AIRTIME = metrics.counter("afskmodem_tx_airtime_seconds_total", "Audio played by the transmitter in seconds")
+
+################################################################################ AUDIO DEVICES
+# Held while PortAudio is set up or torn down, which isn't thread-safe. Receivers and
+# transmitters on different devices may be used from different threads.
+audio_lock = threading.Lock()
+
+# Start PortAudio. PyAudio is imported here on first use rather than with this module, so that
+# the ECC code and replaying recordings work (and import quickly) on machines without it.
+def start_portaudio():
+    import pyaudio
+    return pyaudio.PyAudio()
+
+# List the audio devices PortAudio can see as (index, name, input channels, output channels)
+def list_audio_devices() -> list:
+    with audio_lock:
+        pa = start_portaudio()
+        try:
+            devices = []
+            for i in range(pa.get_device_count()):
+                info = pa.get_device_info_by_index(i)
+                devices.append((i, info["name"], info["maxInputChannels"], info["maxOutputChannels"]))
+            return devices
+        finally:
+            pa.terminate()
+
+# Find the index of an audio device given its index or (part of) its name. None means the
+# system default. Raises ValueError if no device with the needed direction matches.
+def find_audio_device(device, input=True):
+    if(device is None or device == ""):
+        return None
+    channels = 2 if input else 3
+    devices = list_audio_devices()
+    if(isinstance(device, int) or str(device).isdigit()):
+        for d in devices:
+            if(d[0] == int(device) and d[channels] > 0):
+                return d[0]
+    else:
+        for d in devices:
+            if(str(device).lower() in d[1].lower() and d[channels] > 0):
+                return d[0]
+    raise ValueError("No " + ("input" if input else "output") + " audio device matches " + repr(device))
 
 ################################################################################ DIGITAL MODULATION TYPES
 class DigitalModulationTypes:
@@ -106,8 +157,14 @@ class DigitalModulationTypes:
         return "afsk2400"
     def afsk6000() -> str: # Audio Frequency-Shift Keying (6000 baud)
         return "afsk6000"
+    def mfsk4() -> str: # Multiple Frequency-Shift Keying, 4 tones (1200 baud, 2 bits per symbol)
+        return "mfsk4"
+    def mfsk8() -> str: # Multiple Frequency-Shift Keying, 8 tones (600 baud, 3 bits per symbol)
+        return "mfsk8"
     def default() -> str: # Default (AFSK1200)
         return "afsk1200"
+    def get_names() -> list: # Names of the types above (not the helpers below)
+        return ["afsk300", "afsk600", "afsk1200", "afsk2400", "afsk6000", "mfsk4", "mfsk8"]
     
     # Unit time in samples
     def get_unit_time(digital_modulation_type: str) -> int:
@@ -121,6 +178,10 @@ class DigitalModulationTypes:
             return int(SAMPLE_RATE / 2400)
         elif(digital_modulation_type == "afsk6000"):
             return int(SAMPLE_RATE / 6000)
+        elif(digital_modulation_type == "mfsk4"):
+            return int(SAMPLE_RATE / 1200)
+        elif(digital_modulation_type == "mfsk8"):
+            return int(SAMPLE_RATE / 600)
         else: # default
             return int(SAMPLE_RATE / 1200)
 
@@ -136,6 +197,10 @@ class DigitalModulationTypes:
             return int(2400 * sequence_time / 2)
         elif(digital_modulation_type == "afsk6000"):
             return int(6000 * sequence_time / 2)
+        elif(digital_modulation_type == "mfsk4"):
+            return int(1200 * sequence_time / 2)
+        elif(digital_modulation_type == "mfsk8"):
+            return int(600 * sequence_time / 2)
         else: # default
             return int(1200 * sequence_time / 2)
     
@@ -151,6 +216,10 @@ class DigitalModulationTypes:
             return 2400
         elif(digital_modulation_type == "afsk6000"):
             return 6000
+        elif(digital_modulation_type == "mfsk4"):
+            return 1200
+        elif(digital_modulation_type == "mfsk8"):
+            return 600
         else: # default
             return 1200
 
@@ -166,9 +235,45 @@ class DigitalModulationTypes:
             return 4800
         elif(digital_modulation_type == "afsk6000"):
             return 12000
+        elif(digital_modulation_type == "mfsk4"):
+            return 2400
+        elif(digital_modulation_type == "mfsk8"):
+            return 1200
         else: # default
             return 2400
 
+    # Get the frequencies of the tones for a given type, one per symbol value. Multi-tone
+    # types use whole multiples of the symbol rate, which keeps the tones orthogonal over a
+    # symbol and every symbol starting at the same phase. The training block is sent one bit
+    # per symbol on the two lowest tones (space and mark), which squelch like AFSK's.
+    def get_tones(digital_modulation_type: str) -> list:
+        if(digital_modulation_type == "mfsk4"):
+            return [1200, 2400, 3600, 4800]
+        elif(digital_modulation_type == "mfsk8"):
+            return [600, 1200, 1800, 2400, 3000, 3600, 4200, 4800]
+        else: # binary
+            return [DigitalModulationTypes.get_space_tone(digital_modulation_type),
+                    DigitalModulationTypes.get_mark_tone(digital_modulation_type)]
+
+    # Bits carried by each symbol
+    def get_bits_per_symbol(digital_modulation_type: str) -> int:
+        return len(DigitalModulationTypes.get_tones(digital_modulation_type)).bit_length() - 1
+
+    # Is this a multi-tone (MFSK) type? Its waves are synthesized rather than loaded.
+    def is_multitone(digital_modulation_type: str) -> bool:
+        return len(DigitalModulationTypes.get_tones(digital_modulation_type)) > 2
+
+################################################################################ GRAY CODING
+# Symbol values are Gray coded so that mistaking a tone for its neighbour costs one bit
+class GrayCode:
+    # Bit strings for each symbol value
+    def symbol_bits(bits_per_symbol: int) -> list:
+        return ['{0:0{1}b}'.format(i ^ (i >> 1), bits_per_symbol) for i in range(2 ** bits_per_symbol)]
+
+    # Symbol value for each bit string
+    def bits_symbol(bits_per_symbol: int) -> dict:
+        return {b: i for i, b in enumerate(GrayCode.symbol_bits(bits_per_symbol))}
+
 ################################################################################ IDEAL WAVES
 class IdealWaves: # Ideal waves for TX and RX
     def __init__(self, digital_modulation_type = DigitalModulationTypes.default()):
@@ -214,10 +319,40 @@ class IdealWaves: # Ideal waves for TX and RX
     def get_rx_training(self) -> list: 
         return self.get_rx_mark() + self.get_rx_space()
 
+    # One symbol of a tone, as a sine wave for TX or as an ideal square wave for RX
+    def __synthesize_tone(self, frequency: int, square: bool) -> list:
+        unit_time = DigitalModulationTypes.get_unit_time(self.digital_modulation_type)
+        samples = []
+        for i in range(unit_time):
+            v = math.sin(2 * math.pi * frequency * i / SAMPLE_RATE)
+            if(square):
+                samples.append(32767 if v >= 0 else -32767)
+            else:
+                samples.append(int(round(32767 * v)))
+        return samples
+
+    # Each tone of the type, one symbol long, as bytes for TX. Multi-tone types are
+    # synthesized as sines: the harmonics of a square wave would land on other tones.
+    def get_tx_tones(self) -> list:
+        if(not DigitalModulationTypes.is_multitone(self.digital_modulation_type)):
+            return [self.get_tx_space(), self.get_tx_mark()]
+        tones = []
+        for f in DigitalModulationTypes.get_tones(self.digital_modulation_type):
+            samples = self.__synthesize_tone(f, False)
+            tones.append(struct.pack("<" + str(len(samples)) + "h", *samples))
+        return tones
+
+    # Ideal training tones (space, mark) as square waves for RX clock recovery
+    def get_rx_training_tones(self) -> tuple:
+        if(not DigitalModulationTypes.is_multitone(self.digital_modulation_type)):
+            return self.get_rx_space(), self.get_rx_mark()
+        tones = DigitalModulationTypes.get_tones(self.digital_modulation_type)
+        return self.__synthesize_tone(tones[0], True), self.__synthesize_tone(tones[1], True)
+
 ################################################################################ HAMMING ECC
 class Hamming:
     # Each instance of Hamming keeps track of the errors it corrects. 
-    # An instance of Hamming is created for each DigitalTransmitter or DigitalReceiver instance.
+    # An instance of Hamming is created for each DigitalTransmitter, and for each frame a DigitalReceiver demodulates.
     def __init__(self): 
         self.r = 4
         self.error_count = 0
@@ -311,25 +446,137 @@ class Hamming:
         return(output_data)
 
 ################################################################################ RX TOOLS
+class WavFileInput: # Reads a wav file in place of an input stream, to replay recordings through rx()
+    def __init__(self, filename: str):
+        self.wav = wave.open(filename, "r")
+        if(self.wav.getnchannels() != CHANNELS or self.wav.getsampwidth() != 2 or self.wav.getframerate() != SAMPLE_RATE):
+            self.wav.close()
+            raise ValueError(filename + " is not " + str(SAMPLE_RATE) + " Hz 16-bit mono")
+
+    # Read n frames. Raises EOFError at the end of the file.
+    def read(self, n: int, exception_on_overflow=True) -> bytes:
+        frames = self.wav.readframes(n)
+        if(len(frames) == 0):
+            raise EOFError("end of recording")
+        return frames
+
+    def stop_stream(self):
+        pass
+
+    def close(self):
+        self.wav.close()
+
+class BufferInput: # Reads raw 16-bit mono PCM (e.g. a memory-mapped capture journal segment) in place of an input stream
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer).cast("B")
+        self.position = 0
+
+    # Read n frames as a view of the buffer, without copying. Raises EOFError at the end.
+    def read(self, n: int, exception_on_overflow=True) -> memoryview:
+        if(self.position >= len(self.buffer)):
+            raise EOFError("end of recording")
+        start = self.position
+        self.position += n * 2
+        return self.buffer[start:self.position]
+
+    def stop_stream(self):
+        pass
+
+    def close(self):
+        self.buffer = memoryview(b"") # views already read stay valid
+
+class StageTimer: # Reports the time spent in each stage of a receive to a hook(stage, seconds)
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.last = perf_counter() if hook is not None else 0
+        self.inner = 0 # time spent in wrapped iterators
+        self.inner_reported = 0
+        self.inner_stages = {} # wrapped iterator stage -> time spent in it
+
+    # Report the time since the last lap as stage, less any time spent in wrapped iterators
+    def lap(self, stage: str):
+        if(self.hook is not None):
+            now = perf_counter()
+            self.hook(stage, now - self.last - (self.inner - self.inner_reported))
+            self.inner_reported = self.inner
+            self.last = now
+
+    # Time the steps of a lazy iterator as stage, separately from the stages that consume it
+    # (and from iterators wrapped inside it). Returns the iterator itself when there is no hook.
+    def wrap(self, iterator, stage: str):
+        if(self.hook is None):
+            return iterator
+        self.inner_stages.setdefault(stage, 0)
+        return self.__timed(iterator, stage)
+
+    def __timed(self, iterator, stage: str):
+        while True:
+            start = perf_counter()
+            nested = self.inner
+            try:
+                v = next(iterator)
+            except StopIteration:
+                v = StopIteration
+            own = perf_counter() - start - (self.inner - nested)
+            self.inner += own
+            self.inner_stages[stage] += own
+            if(v is StopIteration):
+                return
+            yield v
+
+    # Report the time spent in each wrapped iterator
+    def finish(self):
+        if(self.hook is not None):
+            for stage, seconds in self.inner_stages.items():
+                self.hook(stage, seconds)
+
 class DigitalReceiver:
     def __init__(self,
     digital_modulation_type = DigitalModulationTypes.default(),    
     amp_start_threshold = AMPLITUDE_START_THRESHOLD,
     amp_end_threshold = AMPLITUDE_END_THRESHOLD,
-    amp_deadzone = AMPLIFIER_DEADZONE):
+    amp_deadzone = AMPLIFIER_DEADZONE,
+    input_device = None,
+    streaming = STREAMING_DEMODULATION,
+    adaptive_squelch = ADAPTIVE_SQUELCH,
+    automatic_gain = AUTOMATIC_GAIN):
         self.digital_modulation_type = digital_modulation_type
+        self.streaming = streaming
+        self.adaptive_squelch = adaptive_squelch
+        self.automatic_gain = automatic_gain
         self.amp_start_threshold = amp_start_threshold
         self.amp_end_threshold = amp_end_threshold
         self.amp_deadzone = amp_deadzone
         self.unit_time = DigitalModulationTypes.get_unit_time(self.digital_modulation_type)
         self.space_tone = DigitalModulationTypes.get_space_tone(self.digital_modulation_type)
         self.mark_tone = DigitalModulationTypes.get_mark_tone(self.digital_modulation_type)
-        ideal_waves = IdealWaves(digital_modulation_type = self.digital_modulation_type)
-        self.rx_space = ideal_waves.get_rx_space()
-        self.rx_mark = ideal_waves.get_rx_mark()
-        self.rx_training = ideal_waves.get_rx_training()
-        self.ecc = Hamming()
+        self.multitone = DigitalModulationTypes.is_multitone(self.digital_modulation_type)
+        self.symbol_bits = GrayCode.symbol_bits(DigitalModulationTypes.get_bits_per_symbol(self.digital_modulation_type))
+        # Goertzel coefficients for detecting each tone of a multi-tone type
+        self.tone_coeffs = [2 * math.cos(2 * math.pi * f / SAMPLE_RATE) for f in DigitalModulationTypes.get_tones(self.digital_modulation_type)]
+        self.rx_training = None # ideal waves, loaded with rx_space and rx_mark on the first demodulation
+        self.input_device = find_audio_device(input_device, input=True) # device index (None: default)
+        self.pa = None
+        self.stream = None
+        self.in_burst = False # a frame was returned before its burst ended
+        self.last_block_time = 0
+        self.input_lock = threading.Lock() # held while reading the input
+        self.last_activity_time = 0 # when a block above the squelch close level was last read
+        self.noise_floor = None # chunk amplitude of the input between bursts
+        self.capture = None # writes the input to a capturejournal.CaptureJournal when set
+        # Called as stage_hook(stage, seconds) after each receive stage: record, unpack, clock_recovery,
+        # training_block, ecc (per call), header_filter, then bit_slicing and, when streaming, capture
+        # (which run inside the others as they need audio)
+        self.stage_hook = None
     
+    # Load the ideal waves demodulation compares the input with. Capturing audio doesn't need
+    # them (a ReceiverHost's receivers only capture), so they are loaded on first use.
+    def __load_ideal_waves(self):
+        if(self.rx_training is None):
+            ideal_waves = IdealWaves(digital_modulation_type = self.digital_modulation_type)
+            self.rx_space, self.rx_mark = ideal_waves.get_rx_training_tones()
+            self.rx_training = self.rx_mark + self.rx_space
+
     # Load raw wav data from file
     def __load_raw_wav_data(self, filename: str) -> bytes:
         with wave.open(filename, "r") as f:
@@ -337,12 +584,12 @@ class DigitalReceiver:
             return f.readframes(nframes)
     
     # From sine to square
-    def __amplify_chunk(self, chunk: list) -> list:
+    def __amplify_chunk(self, chunk: list, deadzone: float) -> list:
         amp_chunk = []
         for i in chunk:
-            if(i > self.amp_deadzone):
+            if(i > deadzone):
                 amp_chunk.append(32767)
-            elif(i < -1 * self.amp_deadzone):
+            elif(i < -1 * deadzone):
                 amp_chunk.append(-32767)
             else:
                 amp_chunk.append(0)
@@ -350,43 +597,128 @@ class DigitalReceiver:
 
     # Average deviation from bytes
     def __avg_deviation_bytes(self, frames: bytes) -> int:
-        s_frames = []
-        for i in range(len(frames) - 1): 
-            s_frame = frames[i:i+2]
-            s_frames.append(abs(struct.unpack("<h", s_frame)[0]))
-            i += 2
-        return int(sum(s_frames) / len(s_frames))
+        return self.__avg_deviation_array(self.__unpack_frames(frames))
 
-    # Auto-record and return frames
-    def __auto__record(self, timeout_seconds=-1) -> bytes:
+    # Chunk amplitudes (open, close) at which the squelch opens for a burst and closes after it:
+    # relative to the noise floor with adaptive squelch, otherwise the fixed thresholds
+    def __squelch_levels(self) -> tuple:
+        if(not self.adaptive_squelch or self.noise_floor is None):
+            return self.amp_start_threshold, self.amp_end_threshold
+        open_level = max(self.noise_floor * SQUELCH_OPEN_RATIO, SQUELCH_MIN_LEVEL)
+        return open_level, open_level * SQUELCH_CLOSE_RATIO / SQUELCH_OPEN_RATIO
+
+    # Move the noise floor estimate towards the amplitude of a block heard between bursts
+    def __track_noise_floor(self, chunk_amplitude: int, rise=NOISE_FLOOR_RISE):
+        if(self.noise_floor is None):
+            self.noise_floor = chunk_amplitude
+        elif(chunk_amplitude < self.noise_floor):
+            self.noise_floor += (chunk_amplitude - self.noise_floor) * NOISE_FLOOR_FALL
+        else:
+            self.noise_floor += (chunk_amplitude - self.noise_floor) * rise
+
+    # Get the noise floor estimate (chunk amplitude), or None before any input was heard
+    def get_noise_floor(self):
+        return self.noise_floor
+
+    # Keep an input stream open on this receiver's device until close(), so that
+    # consecutive calls to record() or rx() don't miss audio while it is reopened
+    def open(self):
+        if(self.stream is None):
+            with audio_lock:
+                self.pa = start_portaudio() # Open an input stream with PortAudio
+                self.stream = self.pa.open(format=self.pa.get_format_from_width(SAMPLE_WIDTH), channels=CHANNELS,
+                        rate=SAMPLE_RATE, input=True,
+                        input_device_index=self.input_device,
+                        frames_per_buffer=INPUT_FRAMES_PER_BLOCK)
+
+    # Receive from a recording instead of the input device until close(): a 48 kHz 16-bit mono wav
+    # file, or raw audio in that format (bytes or a view, e.g. CaptureJournal.map_segment()).
+    # rx() and record() raise EOFError once the recording runs out.
+    def replay(self, recording):
+        self.close()
+        if(isinstance(recording, str)):
+            self.stream = WavFileInput(recording)
+        else:
+            self.stream = BufferInput(recording)
+
+    # Close the input stream opened by open() or replay()
+    def close(self):
+        if(self.capture is not None):
+            self.capture.flush()
+        if(self.stream is not None):
+            with audio_lock:
+                self.stream.stop_stream()
+                self.stream.close()
+                if(self.pa is not None):
+                    self.pa.terminate()
+            self.stream = None
+            self.pa = None
+
+    # Open the input stream for one receive if it isn't kept open. Returns True if it was already open.
+    def __begin_input(self) -> bool:
+        if(self.stream is not None):
+            return True
+        self.open()
+        self.stream.read(INPUT_FRAMES_PER_BLOCK) # Flush input buffer
+        return False
+
+    def __end_input(self, keep_open: bool):
+        if(not keep_open):
+            self.close()
+            self.in_burst = False
+
+    # Wait until a burst starts. Returns False on timeout (seconds, disabled when not positive).
+    def __wait_for_burst(self, timeout_seconds=-1) -> bool:
         timeout_iters = round(timeout_seconds * (SAMPLE_RATE/INPUT_FRAMES_PER_BLOCK))
-        pa = pyaudio.PyAudio() # Open an input stream with PortAudio
-        stream = pa.open(format=FORMAT, channels=CHANNELS,
-                rate=SAMPLE_RATE, input=True,
-                frames_per_buffer=INPUT_FRAMES_PER_BLOCK)
-        stream.read(INPUT_FRAMES_PER_BLOCK) # Flush input buffer
         listener_iters = 0
         while (True):
             listener_iters += 1
             if(listener_iters > timeout_iters and timeout_seconds > 0):
-                # Close stream and return nothing if timeout is reached
-                stream.stop_stream()
-                stream.close()
-                pa.terminate()
-                return b''
-            
-            recorded_frames = []
-            block_frames = stream.read(INPUT_FRAMES_PER_BLOCK) # Record and sample
+                return False
+            block_frames = self.stream.read(INPUT_FRAMES_PER_BLOCK, exception_on_overflow=False) # Record and sample
+            if(self.capture is not None):
+                self.capture.write(block_frames, self.in_burst)
             chunk_amplitude = self.__avg_deviation_bytes(block_frames)
-            if(chunk_amplitude > self.amp_start_threshold): # Record and return
-                while(chunk_amplitude > self.amp_end_threshold):
-                    block_frames = stream.read(INPUT_FRAMES_PER_BLOCK)
-                    recorded_frames.append(block_frames)
-                    chunk_amplitude = self.__avg_deviation_bytes(block_frames)
-                stream.stop_stream()
-                stream.close()
-                pa.terminate()
-                return b''.join(recorded_frames)
+            open_level, close_level = self.__squelch_levels()
+            if(chunk_amplitude > close_level):
+                self.last_activity_time = perf_counter()
+            if(self.in_burst): # the rest of a burst a frame was already taken from
+                self.in_burst = chunk_amplitude > close_level
+                if(self.adaptive_squelch):
+                    self.__track_noise_floor(chunk_amplitude, NOISE_FLOOR_BURST_RISE)
+            elif(chunk_amplitude > open_level):
+                log(0, "Receiver - burst at chunk amplitude %d (squelch opens at %d).", chunk_amplitude, open_level)
+                return True
+            elif(self.adaptive_squelch):
+                self.__track_noise_floor(chunk_amplitude)
+
+    # Iterate over the blocks of the burst that just started, as they are recorded, until the carrier drops
+    def __iter_burst_blocks(self):
+        self.in_burst = True
+        while(True):
+            block_frames = self.stream.read(INPUT_FRAMES_PER_BLOCK, exception_on_overflow=False)
+            if(self.capture is not None):
+                self.capture.write(block_frames, True)
+            self.last_block_time = perf_counter()
+            self.last_activity_time = self.last_block_time
+            chunk_amplitude = self.__avg_deviation_bytes(block_frames)
+            if(self.adaptive_squelch):
+                self.__track_noise_floor(chunk_amplitude, NOISE_FLOOR_BURST_RISE)
+            yield block_frames
+            if(chunk_amplitude <= self.__squelch_levels()[1]):
+                break
+        self.in_burst = False
+
+    # Auto-record and return frames
+    def __auto__record(self, timeout_seconds=-1) -> bytes:
+        with self.input_lock:
+            keep_open = self.__begin_input()
+            try:
+                if(not self.__wait_for_burst(timeout_seconds)):
+                    return b'' # Return nothing if timeout is reached
+                return b''.join(self.__iter_burst_blocks())
+            finally:
+                self.__end_input(keep_open)
 
     # Unsigned average deviation from audio stored as ints
     def __avg_deviation_array(self, chunk: list) -> int: 
@@ -403,9 +735,9 @@ class DigitalReceiver:
         return int(sum(differences) / len(differences))
 
     # Recover the clock from a chunk of audio by scanning the training sequence
-    def __recover_clock_index(self, chunk: list) -> int:
+    def __recover_clock_index(self, chunk: list, deadzone: float) -> int:
         try:
-            fit_chunk = self.__amplify_chunk(chunk[0:CLOCK_SCAN_WIDTH]) 
+            fit_chunk = self.__amplify_chunk(chunk[0:CLOCK_SCAN_WIDTH], deadzone)
             fit_devs = []
             # Create an array of deviations
             for i in range(len(fit_chunk) - self.unit_time * 2 - 1): 
@@ -419,118 +751,303 @@ class DigitalReceiver:
             return -1
 
     # Check if a chunk's value is 1 or 0 based on its similarity to ideal waves.
-    def __get_bit_value(self, chunk: list) -> str:
+    def __get_bit_value(self, chunk: list, deadzone: float) -> int:
         # Amplify received wave to approximate to a square wave
-        decChunk = self.__amplify_chunk(chunk)
+        decChunk = self.__amplify_chunk(chunk, deadzone)
         # Compare to ideal square waves
         markDiff = self.__compare_samples(self.rx_mark, decChunk)
         spaceDiff = self.__compare_samples(self.rx_space, decChunk)
         if(markDiff < spaceDiff):
-            return "1"
+            return 1
         else:
-            return "0"
-
-    # Get bits from wav data
-    def __get_bits_from_wav_data(self, frames: bytes) -> str:
-            exp_frames = []
-            bits = ""
-            frame_iter = 0
-            # Unpack bytes data to array of amplitudes
-            while(frame_iter < len(frames) - 1): 
-                s_frame = frames[frame_iter:frame_iter+2]
-                exp_frames.append(struct.unpack("<h", s_frame)[0])
-                frame_iter += 2
-            nFrames = len(exp_frames)
-
-            # Recover the clock
-            start_sample = self.__recover_clock_index(exp_frames) 
-            
-            # If no start sample could be found we can't decode
-            if(start_sample == -1): 
-                return ""
-            
-            # Decode to bits (including training block, we'll trim it off later)
-            chunk_iter = int(self.unit_time) + start_sample 
-            while(chunk_iter < nFrames - 1):
-                chunk = exp_frames[int(chunk_iter - self.unit_time):int(chunk_iter)]
-                # End decode when no more data is being transmitted
-                if(self.__avg_deviation_array(chunk) < self.amp_end_threshold): 
-                    break
-                bits += self.__get_bit_value(chunk)
-                chunk_iter += self.unit_time
-            return bits
-
-    # Trim the training block off of received bits
-    def __trim_training_block(self, data: str) -> str:
+            return 0
+
+    # Find which tone a chunk of a multi-tone type carries: the one with the most power
+    # in a Goertzel filter over the symbol
+    def __get_tone_value(self, chunk: list) -> int:
+        best_tone = 0
+        best_power = -1
+        for tone, coeff in enumerate(self.tone_coeffs):
+            s1 = 0.0
+            s2 = 0.0
+            for x in chunk:
+                s1, s2 = x + coeff * s1 - s2, s1
+            power = s1 * s1 + s2 * s2 - coeff * s1 * s2
+            if(power > best_power):
+                best_tone = tone
+                best_power = power
+        return best_tone
+
+    # Unpack wav data to an array of amplitudes
+    def __unpack_frames(self, frames: bytes) -> list:
+        n_frames = len(frames) // 2
+        return list(struct.unpack("<" + str(n_frames) + "h", frames[0:n_frames * 2]))
+
+    # Iterate over the symbol values in wav data (training block included) from the recovered
+    # clock, until a symbol's amplitude is below end_level. When the audio in exp_frames runs out,
+    # more is taken from blocks (raw wav data, e.g. still being recorded), and samples already
+    # sliced are dropped.
+    def __iter_symbols(self, exp_frames: list, start_sample: int, blocks, deadzone: float, end_level: float):
+        blocks = iter(blocks)
+        if(self.multitone):
+            get_value = self.__get_tone_value
+        else:
+            get_value = lambda chunk: self.__get_bit_value(chunk, deadzone)
+        chunk_iter = int(self.unit_time) + start_sample
+        while(True):
+            while(chunk_iter >= len(exp_frames) - 1):
+                block_frames = next(blocks, None)
+                if(block_frames is None):
+                    return
+                sliced = chunk_iter - int(self.unit_time)
+                exp_frames = exp_frames[sliced:] + self.__unpack_frames(block_frames)
+                chunk_iter -= sliced
+            chunk = exp_frames[int(chunk_iter - self.unit_time):int(chunk_iter)]
+            # End decode when no more data is being transmitted
+            if(self.__avg_deviation_array(chunk) < end_level):
+                return
+            yield get_value(chunk)
+            chunk_iter += self.unit_time
+
+    # Consume the training block (sent on the space and mark tones) from a symbol stream.
+    # Returns the first data symbol, or -1 if the stream ended before the training block did.
+    def __skip_training_block(self, symbols) -> int:
         training_bits = 0
         zero_count = 0
-        end_training_index = 0
-        for i in range(len(data)-1):
-            if(data[i] != data[i+1]):
-                training_bits += 1
-            if(data[i] == "0"):
-                zero_count += 1
-                if(zero_count > 2 and training_bits > 16):
-                    end_training_index = i + 1
-                    break
-            else:
-                zero_count = 0
-        return(data[end_training_index::])
-
-    # Convert bits to bytes
-    def __get_bytes_from_bits(self, b_data: str) -> bytes:
-        int_data = []
-        i = 0
-        while(i < len(b_data)):
-            int_data.append(int(b_data[(i):(i+8)], 2))
-            i += 8
-        return bytes(int_data)
-    
-    # Run error correction and remove all parity bits from bits data
-    def __get_data_from_ecc(self, data: str) -> str:
-        data_bytes = []
-        decoded_bytes = []
-        data_iter = 0
-        self.ecc.reset_error_count()
-        while(data_iter < len(data) - 11):
-            data_bytes.append(data[data_iter:data_iter+12])
-            data_iter += 12
-        for dataByte in data_bytes:
-            decoded_bytes.append(self.ecc.decode(dataByte))
-        output = "".join(decoded_bytes)
-        return output, self.ecc.get_error_count()
-    
-    # One call to receive bytes data from default audio input (timeout in seconds, disabled by default)
-    def rx(self, timeout=-1):
-        log(0, "Receiver - listening...")
-        wav_data = self.__auto__record(timeout)
-        if(wav_data == b""): # if timed out
-            log(1, "Receiver - timed out.")
+        last_bit = ""
+        for symbol in symbols:
+            bit = "0" if symbol == 0 else "1"
+            if(last_bit != ""):
+                if(last_bit != bit):
+                    training_bits += 1
+                if(last_bit == "0"):
+                    zero_count += 1
+                    if(zero_count > 2 and training_bits > 16):
+                        return symbol
+                else:
+                    zero_count = 0
+            last_bit = bit
+        return -1
+
+    # Run error correction on a bit stream and return up to n data bytes (n < 0: until the stream ends)
+    def __read_ecc_bytes(self, ecc: Hamming, bits, n: int) -> bytes:
+        output = bytearray()
+        while(n < 0 or len(output) < n):
+            data_byte = "".join(islice(bits, 12))
+            if(len(data_byte) < 12):
+                break
+            output.append(int(ecc.decode(data_byte), 2))
+        return bytes(output)
+
+    # Read a frame's header, or return None if the stream ends first. header_length is its length
+    # in bytes, or for headers whose length varies a function giving the full length from as much
+    # of the header as has been read so far (starting with none of it).
+    def __read_header(self, ecc: Hamming, bits, header_length):
+        if(not callable(header_length)):
+            header = self.__read_ecc_bytes(ecc, bits, header_length)
+            return header if len(header) == header_length else None
+        header = b""
+        length = header_length(header)
+        while(len(header) < length):
+            more = self.__read_ecc_bytes(ecc, bits, length - len(header))
+            if(len(more) < length - len(header)):
+                return None
+            header += more
+            length = header_length(header)
+        return header
+
+    # Demodulate recorded wav data. If a header handler is given, the first header_length
+    # bytes are decoded and passed to it (header_length may also be a function, see
+    # __read_header); it returns how many more bytes to decode, or -1 to abort the frame.
+    # Otherwise decoding runs until the carrier drops. Safe to call from several threads at
+    # once: every call counts its corrections with its own Hamming.
+    def demodulate(self, wav_data: bytes, header_length=0, header_handler=None):
+        timer = StageTimer(self.stage_hook)
+        try:
+            exp_frames = self.__unpack_frames(wav_data)
+            timer.lap("unpack")
+            return self.__demodulate_frames(timer, exp_frames, (), header_length, header_handler)
+        finally:
+            timer.finish()
+
+    # Demodulate a burst while it is being recorded: the clock is recovered as soon as
+    # CLOCK_SCAN_WIDTH samples are in, then each block is sliced into bits and error-corrected
+    # bytes as it arrives. With a header handler this returns as soon as the frame's last
+    # byte is decoded, without waiting for the carrier to drop.
+    def __demodulate_stream(self, timer: StageTimer, blocks, header_length=0, header_handler=None):
+        blocks = timer.wrap(blocks, "capture")
+        head = []
+        head_length = 0
+        for block_frames in blocks:
+            head.append(block_frames)
+            head_length += len(block_frames) // 2
+            if(head_length >= CLOCK_SCAN_WIDTH):
+                break
+        exp_frames = self.__unpack_frames(b''.join(head))
+        timer.lap("unpack")
+        return self.__demodulate_frames(timer, exp_frames, blocks, header_length, header_handler)
+
+    # Demodulate from the start of a burst (see demodulate), taking more audio from blocks when needed
+    def __demodulate_frames(self, timer: StageTimer, exp_frames: list, blocks, header_length=0, header_handler=None):
+        self.__load_ideal_waves()
+        # Normalize the burst to AMPLITUDE_REFERENCE, measured over the training sequence. Rather
+        # than scaling every sample, the levels they are compared with are scaled the other way.
+        deadzone = self.amp_deadzone
+        end_level = self.amp_end_threshold
+        if(self.automatic_gain and len(exp_frames) > 0):
+            level = max(1, self.__avg_deviation_array(exp_frames[0:CLOCK_SCAN_WIDTH])) / AMPLITUDE_REFERENCE
+            deadzone *= level
+            end_level *= level
+        # Recover the clock. If no start sample could be found we can't decode
+        start_sample = self.__recover_clock_index(exp_frames, deadzone)
+        timer.lap("clock_recovery")
+        if(start_sample == -1):
+            RX_SYNC_FAILURES.inc()
+            log(1, "Receiver - bad packet.")
             return b"", 0
-        bd = self.__get_bits_from_wav_data(wav_data)
-        if(bd == ""): # if no good data
+        symbols = timer.wrap(self.__iter_symbols(exp_frames, start_sample, blocks, deadzone, end_level), "bit_slicing")
+        first_symbol = self.__skip_training_block(symbols)
+        timer.lap("training_block")
+        if(first_symbol == -1):
+            RX_SYNC_FAILURES.inc()
             log(1, "Receiver - bad packet.")
             return b"", 0
-        bd = self.__trim_training_block(bd)
-        decoded_bin, error_count = self.__get_data_from_ecc(bd)
-        bytes_data = self.__get_bytes_from_bits(decoded_bin)
-        log(0, "Receiver - done.")
+        # Gray-decoded bits of the data symbols
+        bits = chain.from_iterable(map(self.symbol_bits.__getitem__, chain((first_symbol,), symbols)))
+        ecc = Hamming()
+        if(header_handler is None):
+            data = self.__read_ecc_bytes(ecc, bits, -1)
+            timer.lap("ecc")
+            return data, ecc.get_error_count()
+        header = self.__read_header(ecc, bits, header_length)
+        timer.lap("ecc")
+        if(header is None):
+            log(1, "Receiver - bad packet.")
+            return b"", 0
+        remaining = header_handler(header)
+        timer.lap("header_filter")
+        if(remaining < 0):
+            RX_REJECTED.inc()
+            log(0, "Receiver - frame rejected by header filter.")
+            return b"", 0
+        data = self.__read_ecc_bytes(ecc, bits, remaining)
+        timer.lap("ecc")
+        return header + data, ecc.get_error_count()
+
+    # rx() with streaming demodulation
+    def __stream_rx(self, timeout=-1, header_length=0, header_handler=None):
+        timer = StageTimer(self.stage_hook)
+        with self.input_lock:
+            keep_open = self.__begin_input()
+            try:
+                burst = self.__wait_for_burst(timeout)
+                timer.lap("record")
+                if(not burst):
+                    RX_TIMEOUTS.inc()
+                    log(1, "Receiver - timed out.")
+                    return b"", 0
+                RX_BURSTS.inc()
+                blocks = self.__iter_burst_blocks()
+                headers = [] # headers decoded from this burst
+                def handle_header(header: bytes) -> int:
+                    headers.append(header)
+                    return header_handler(header)
+                bytes_data, error_count = self.__demodulate_stream(timer, blocks, header_length,
+                                                                  None if header_handler is None else handle_header)
+                RX_DECODE_SECONDS.observe(perf_counter() - self.last_block_time)
+                if(bytes_data == b""): # Let the rest of a bad or rejected burst pass, as recording it would have.
+                    # Nothing at all could be decoded from it: it is noise, so the squelch learns to stay shut.
+                    noise = self.adaptive_squelch and len(headers) == 0
+                    for block_frames in blocks:
+                        if(noise):
+                            self.__track_noise_floor(self.__avg_deviation_bytes(block_frames))
+                return bytes_data, error_count
+            finally:
+                timer.finish()
+                self.__end_input(keep_open)
+
+    # Listen for sense_time seconds and return True if something is transmitting (any block above
+    # the squelch close level). If another thread is in rx() or record() the input is theirs, so what
+    # they read in the meantime is used instead of reading it here.
+    def channel_busy(self, sense_time=CARRIER_SENSE_TIME) -> bool:
+        if(not self.input_lock.acquire(blocking=False)):
+            sleep(sense_time) # (allowing for the block being read when sensing started)
+            return self.in_burst or perf_counter() - self.last_activity_time < sense_time + INPUT_FRAMES_PER_BLOCK / SAMPLE_RATE
+        try:
+            keep_open = self.__begin_input()
+            try:
+                for i in range(max(1, round(sense_time * SAMPLE_RATE / INPUT_FRAMES_PER_BLOCK))):
+                    block_frames = self.stream.read(INPUT_FRAMES_PER_BLOCK, exception_on_overflow=False)
+                    if(self.capture is not None):
+                        self.capture.write(block_frames, False)
+                    chunk_amplitude = self.__avg_deviation_bytes(block_frames)
+                    if(chunk_amplitude > self.__squelch_levels()[1]):
+                        self.last_activity_time = perf_counter()
+                        return True
+                    if(self.adaptive_squelch):
+                        self.__track_noise_floor(chunk_amplitude)
+                return False
+            finally:
+                self.__end_input(keep_open)
+        finally:
+            self.input_lock.release()
+
+    # Wait for a burst on the input device and return its audio, or b"" on timeout (seconds,
+    # disabled by default). Demodulate it with demodulate(); rx() does both.
+    def record(self, timeout=-1) -> bytes:
+        return self.__auto__record(timeout)
+
+    # One call to receive bytes data from the input device (timeout in seconds, disabled by default).
+    # See demodulate for header_length and header_handler.
+    def rx(self, timeout=-1, header_length=0, header_handler=None):
+        log(0, "Receiver - listening...")
+        if(self.streaming):
+            bytes_data, error_count = self.__stream_rx(timeout, header_length, header_handler)
+        else:
+            timer = StageTimer(self.stage_hook)
+            wav_data = self.__auto__record(timeout)
+            timer.lap("record")
+            if(wav_data == b""): # if timed out
+                RX_TIMEOUTS.inc()
+                log(1, "Receiver - timed out.")
+                return b"", 0
+            RX_BURSTS.inc()
+            bytes_data, error_count = self.demodulate(wav_data, header_length, header_handler)
+            RX_DECODE_SECONDS.observe(perf_counter() - self.last_block_time)
+        RX_BYTES.inc(len(bytes_data))
+        RX_ECC_CORRECTIONS.inc(error_count)
+        if(bytes_data != b""):
+            log(0, "Receiver - done.")
         return bytes_data, error_count
 
 ################################################################################ TX TOOLS
 class DigitalTransmitter:
     def __init__(self, 
     digital_modulation_type = DigitalModulationTypes.default(),
-    training_sequence_time = TRAINING_SEQUENCE_TIME):
+    training_sequence_time = TRAINING_SEQUENCE_TIME,
+    output_device = None):
         self.digital_modulation_type = digital_modulation_type
+        self.output_device = find_audio_device(output_device, input=False) # device index (None: default)
         self.ts_oscillations = DigitalModulationTypes.get_ts_oscillations(training_sequence_time, self.digital_modulation_type)
         self.unit_time = DigitalModulationTypes.get_unit_time(self.digital_modulation_type)
-        ideal_waves = IdealWaves(digital_modulation_type = self.digital_modulation_type)
-        self.tx_space = ideal_waves.get_tx_space()
-        self.tx_mark = ideal_waves.get_tx_mark()
-        self.tx_silence = ideal_waves.get_tx_silence()
+        self.bits_per_symbol = DigitalModulationTypes.get_bits_per_symbol(self.digital_modulation_type)
+        self.tx_symbols = None # audio for each group of bits_per_symbol data bits, loaded on the first tx()
         self.ecc = Hamming()
 
+    # Load the ideal waves transmissions are made of on first use, so that an interface that
+    # never transmits (or only estimates airtime) doesn't read them
+    def __load_ideal_waves(self):
+        if(self.tx_symbols is None):
+            ideal_waves = IdealWaves(digital_modulation_type = self.digital_modulation_type)
+            self.tx_tones = ideal_waves.get_tx_tones()
+            self.tx_space = self.tx_tones[0]
+            self.tx_mark = self.tx_tones[1]
+            self.tx_silence = ideal_waves.get_tx_silence()
+            tx_symbols = {}
+            for bits, symbol in GrayCode.bits_symbol(self.bits_per_symbol).items():
+                tx_symbols[bits] = self.tx_tones[symbol]
+            self.tx_symbols = tx_symbols
+
     # Get bits from bytes
     def __get_bits_from_bytes(self, b_in: bytes) -> str:
         bits = ""
@@ -538,17 +1055,21 @@ class DigitalTransmitter:
             bits += '{0:08b}'.format(b_in[i])
         return bits
 
-    # Encode bits to audio
-    def __encode(self, bits: str) -> bytes:
-        out_frames = []
+    # Encode bits to audio: the training block one bit per symbol (space or mark), then the
+    # data bits_per_symbol bits at a time (every ECC byte is 12 bits, so they divide evenly)
+    def __encode(self, training_bits: str, data_bits: str) -> bytes:
+        self.__load_ideal_waves()
+        out_frames = bytearray()
         # Pad the start of the file with silence
         out_frames += self.tx_silence
         # Write the data freqs to the file
-        for bit in bits:
+        for bit in training_bits:
             if(bit == "0"):
                 out_frames += self.tx_space
             else:
                 out_frames += self.tx_mark
+        for i in range(0, len(data_bits), self.bits_per_symbol):
+            out_frames += self.tx_symbols[data_bits[i:i+self.bits_per_symbol]]
         # Pad the end of the file with silence
         out_frames += self.tx_silence
         return bytes(out_frames)
@@ -575,30 +1096,37 @@ class DigitalTransmitter:
 
     # Play a sound from wav data
     def __play_wav_data(self, data: bytes):
-            # Open an output stream with PortAudio
-            pa = pyaudio.PyAudio()
+        # Open an output stream with PortAudio
+        with audio_lock:
+            pa = start_portaudio()
             stream = pa.open(
-                format = FORMAT,
+                format = pa.get_format_from_width(SAMPLE_WIDTH),
                 channels = CHANNELS,
                 rate = SAMPLE_RATE,
-                output = True
+                output = True,
+                output_device_index = self.output_device
             )
+        try:
             # Write data to the stream
             stream.write(data)
             sleep(0.1) # let the stream finish
-            stream.close()
-            stream.stop_stream()
-            pa.terminate()
+        finally:
+            with audio_lock:
+                stream.stop_stream()
+                stream.close()
+                pa.terminate()
 
-    def tx(self, data: bytes): # One call to send bytes data over default audio output
-        log(0, "Transmitter - sending " + str(len(data)) + " bytes...")
+    def tx(self, data: bytes): # One call to send bytes data over the output device
+        log(0, "Transmitter - sending %d bytes...", len(data))
         message_bits = self.__get_bits_from_bytes(data)
         ecc_bits = self.__insert_ecc(message_bits)
         training_block = self.__make_training_block()
-        tx_bits = training_block + ecc_bits
-        out_frames = self.__encode(tx_bits)
+        out_frames = self.__encode(training_block, ecc_bits)
         self.__play_wav_data(out_frames)
+        TX_FRAMES.inc()
+        TX_BYTES.inc(len(data))
+        TX_AIRTIME.inc(len(out_frames) / (2 * SAMPLE_RATE))
         log(0, "Transmitter - done.")
     
     def est_tx_time(self, data_length: int): # Estimate transmission time in seconds
-        return (self.ts_oscillations * 2 + data_length * 12) / (SAMPLE_RATE / self.unit_time)
+        return (self.ts_oscillations * 2 + data_length * 12 / self.bits_per_symbol) / (SAMPLE_RATE / self.unit_time)
@@ -0,0 +1,145 @@
+"""
+x----------------------------------------------x
+| Capture journal - Raw audio a receiver       |
+| heard, kept for re-decoding later.           |
+x----------------------------------------------x
+"""
+import atexit
+import mmap
+import os
+from time import time
+import afskmodem
+import mercurylog
+
+################################################################################ PROGRAM DEFAULTS
+# Where to keep the journal
+CAPTURE_DIR = "captures"
+#
+# Seconds of audio per segment file (a 48 kHz 16-bit mono minute is 5.5 MiB)
+CAPTURE_SEGMENT_SECONDS = 600
+#
+# Most segment files kept. The oldest is deleted (with its bursts) when another is started.
+CAPTURE_MAX_SEGMENTS = 12
+
+################################################################################ LOGGING
+# Logging level (0: INFO, 1: WARN (recommended), 2: ERROR, 3: NONE)
+LOG_LEVEL = 0
+#
+# How the log identifies which module is logging. (Log output is configured in mercurylog.py)
+LOG_PREFIX = "(CaptureJournal)"
+
+log = mercurylog.get_logger(LOG_PREFIX, LOG_LEVEL)
+
+################################################################################ JOURNAL
+# Segments are raw 16-bit mono PCM at afskmodem.SAMPLE_RATE, numbered in the order they were
+# written. index.txt has one line per burst: "time segment offset length" (Unix time of the
+# burst's first block, offset and length in bytes). A burst never spans two segments.
+class CaptureJournal:
+    # whole_stream: also keep the audio between bursts, not just the bursts the squelch opened for
+    def __init__(self, directory=CAPTURE_DIR, whole_stream=False, segment_seconds=CAPTURE_SEGMENT_SECONDS,
+                 max_segments=CAPTURE_MAX_SEGMENTS):
+        self.directory = directory
+        self.whole_stream = whole_stream
+        self.segment_bytes = int(segment_seconds * afskmodem.SAMPLE_RATE * 2)
+        self.max_segments = max_segments
+        self.index_path = os.path.join(directory, "index.txt")
+        os.makedirs(directory, exist_ok=True)
+        self.file = None # segment being written, opened on the first write
+        self.segment = -1
+        self.offset = 0
+        self.burst_start = None # (time, offset) of the burst being written
+        atexit.register(self.close)
+
+    def __segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, "{0:06d}.pcm".format(segment))
+
+    # Get the numbers of the segments on disk, oldest first
+    def get_segments(self) -> list:
+        segments = []
+        for name in os.listdir(self.directory):
+            if(name.endswith(".pcm") and name[:-4].isdigit()):
+                segments.append(int(name[:-4]))
+        return sorted(segments)
+
+    # Start a new segment, deleting the oldest ones past max_segments
+    def __rotate(self):
+        if(self.file is not None):
+            self.file.close()
+        segments = self.get_segments()
+        self.segment = segments[-1] + 1 if len(segments) > 0 else 0
+        self.file = open(self.__segment_path(self.segment), "wb")
+        self.offset = 0
+        segments.append(self.segment)
+        if(len(segments) > self.max_segments):
+            expired = segments[0:len(segments) - self.max_segments]
+            for segment in expired:
+                os.remove(self.__segment_path(segment))
+            kept = [b for b in self.get_bursts() if b[1] not in expired]
+            with open(self.index_path + ".tmp", "w") as f:
+                f.writelines("%.3f %d %d %d\n" % b for b in kept)
+            os.replace(self.index_path + ".tmp", self.index_path)
+            log(0, "Deleted %d old capture segments.", len(expired))
+
+    # Close the burst being written and add it to the index
+    def __end_burst(self):
+        start_time, start_offset = self.burst_start
+        self.burst_start = None
+        self.file.flush() # so that everything in the index can be read back
+        with open(self.index_path, "a") as f:
+            f.write("%.3f %d %d %d\n" % (start_time, self.segment, start_offset, self.offset - start_offset))
+
+    # Write a block of audio the receiver read. burst: whether it is part of a burst.
+    def write(self, block_frames: bytes, burst: bool):
+        if(burst and self.burst_start is None):
+            if(self.file is None or self.offset >= self.segment_bytes):
+                self.__rotate()
+            self.burst_start = (time(), self.offset)
+        elif(not burst and self.burst_start is not None):
+            self.__end_burst()
+        if(burst or self.whole_stream):
+            if(self.file is None or (self.burst_start is None and self.offset >= self.segment_bytes)):
+                self.__rotate()
+            self.file.write(block_frames)
+            self.offset += len(block_frames)
+
+    # Finish the burst being written, if any (the receiver calls this when its input closes)
+    def flush(self):
+        if(self.burst_start is not None):
+            self.__end_burst()
+        if(self.file is not None):
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        if(self.file is not None):
+            self.file.close()
+            self.file = None
+
+    # Get the bursts in the index, oldest first, as (time, segment, offset, length) tuples.
+    # since and until are Unix times. Another process may be writing the journal meanwhile.
+    def get_bursts(self, since=None, until=None) -> list:
+        bursts = []
+        if(not os.path.exists(self.index_path)):
+            return bursts
+        with open(self.index_path) as f:
+            for line in f:
+                fields = line.split()
+                if(len(fields) != 4):
+                    continue # partly written
+                burst = (float(fields[0]), int(fields[1]), int(fields[2]), int(fields[3]))
+                if((since is None or burst[0] >= since) and (until is None or burst[0] < until)):
+                    bursts.append(burst)
+        return bursts
+
+    # Memory-map a segment and return a read-only view of its audio. Nothing is read until it
+    # is used; pass it to DigitalReceiver.replay() to receive from it with rx() as if live.
+    def map_segment(self, segment: int) -> memoryview:
+        with open(self.__segment_path(segment), "rb") as f:
+            if(os.fstat(f.fileno()).st_size == 0):
+                return memoryview(b"")
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    # Get a view of a burst's audio (from get_bursts) without copying it, for DigitalReceiver.demodulate()
+    def map_burst(self, burst: tuple) -> memoryview:
+        start_time, segment, offset, length = burst
+        return self.map_segment(segment)[offset:offset + length]
@@ -0,0 +1,148 @@
+"""
+x----------------------------------------------x
+| Mercury logging - One non-blocking log for   |
+| AFSKmodem, ADR-CFS and the pager tools.      |
+x----------------------------------------------x
+"""
+import os
+import sys
+import atexit
+import threading
+import queue
+from datetime import datetime
+from time import time, monotonic
+
+################################################################################ PROGRAM DEFAULTS
+# Should the log output to the console?
+LOG_TO_CONSOLE = True
+#
+# Should the log output to a log file?
+LOG_TO_FILE = False
+#
+# Where to generate logfile if need be
+LOG_PATH = "mercury.log"
+#
+# Size in bytes at which the log file is rotated, and how many old files to keep (LOG_PATH.1, .2, ...)
+LOG_MAX_BYTES = 4 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+#
+# Most seconds a written line may wait in the file buffer before being flushed
+LOG_FLUSH_INTERVAL = 1.0
+
+LEVEL_NAMES = {0: " [INFO] ", 1: " [WARN] "}
+
+################################################################################ WRITER
+class LogWriter: # Formats and writes records on a background thread
+    def __init__(self):
+        self.records = queue.SimpleQueue()
+        self.file = None
+        self.thread = None
+        self.lock = threading.Lock()
+        if(hasattr(os, "register_at_fork")):
+            os.register_at_fork(after_in_child=self.__after_fork)
+
+    # A forked child (e.g. a decoding worker) gets none of the parent's threads; start afresh
+    def __after_fork(self):
+        self.records = queue.SimpleQueue()
+        self.file = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    # Queue a record (time, level, prefix, message, args). Never blocks on I/O.
+    def put(self, record: tuple):
+        if(self.thread is None):
+            self.__start()
+        self.records.put(record)
+
+    def __start(self):
+        with self.lock:
+            if(self.thread is None):
+                self.thread = threading.Thread(target=self.__write_loop, name="mercurylog", daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    # Write everything queued so far and stop the writer thread
+    def close(self):
+        if(self.thread is not None and self.thread.is_alive()):
+            self.records.put(None)
+            self.thread.join(5)
+
+    def __format(self, record: tuple) -> str:
+        t, level, prefix, message, args = record
+        if(len(args) > 0):
+            try:
+                message = message % args
+            except Exception:
+                message = message + " " + repr(args)
+        return (datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S') + LEVEL_NAMES.get(level, " [ERR!] ")
+                + prefix + " " + message)
+
+    def __open_file(self):
+        self.file = open(LOG_PATH, "a")
+        self.file_size = self.file.tell()
+
+    # Move LOG_PATH to LOG_PATH.1 (and so on) and start a new file
+    def __rotate(self):
+        self.file.close()
+        for i in range(LOG_BACKUP_COUNT - 1, 0, -1):
+            if(os.path.exists(LOG_PATH + "." + str(i))):
+                os.replace(LOG_PATH + "." + str(i), LOG_PATH + "." + str(i + 1))
+        if(LOG_BACKUP_COUNT > 0):
+            os.replace(LOG_PATH, LOG_PATH + ".1")
+        else:
+            os.remove(LOG_PATH)
+        self.__open_file()
+
+    def __write_loop(self):
+        last_flush = monotonic()
+        while True:
+            try:
+                record = self.records.get(timeout=LOG_FLUSH_INTERVAL)
+            except queue.Empty:
+                record = ""
+            if(record is None): # closing
+                if(self.file is not None):
+                    self.file.close()
+                    self.file = None
+                return
+            if(record != ""):
+                try:
+                    line = self.__format(record)
+                    if(LOG_TO_CONSOLE):
+                        print(line)
+                    if(LOG_TO_FILE):
+                        if(self.file is None):
+                            self.__open_file()
+                        self.file.write(line + "\n")
+                        self.file_size += len(line) + 1
+                        if(self.file_size > LOG_MAX_BYTES):
+                            self.__rotate()
+                except Exception as e:
+                    sys.stderr.write("mercurylog: could not write log record: " + str(e) + "\n")
+            # Flush in batches: when the queue runs dry or the interval passes
+            if(self.file is not None and (self.records.empty() or monotonic() - last_flush > LOG_FLUSH_INTERVAL)):
+                self.file.flush()
+                last_flush = monotonic()
+
+WRITER = LogWriter()
+
+################################################################################ LOGGERS
+class Logger:
+    # Logging level (0: INFO, 1: WARN (recommended), 2: ERROR, 3: NONE)
+    def __init__(self, prefix: str, level=0):
+        self.prefix = prefix
+        self.level = level
+
+    # Log a message. Any args are %-formatted into it on the writer thread, and only if
+    # the level is enabled, so log(0, "Got %s bytes", n) costs almost nothing when filtered.
+    def __call__(self, level: int, message: str, *args):
+        if(level >= self.level):
+            WRITER.put((time(), level, self.prefix, message, args))
+
+    # Is a level enabled? (To skip building expensive arguments)
+    def enabled(self, level: int) -> bool:
+        return level >= self.level
+
+# Get a logger for a module, identified in the log by prefix
+def get_logger(prefix: str, level=0) -> Logger:
+    return Logger(prefix, level)
@@ -0,0 +1,151 @@
+"""
+x----------------------------------------------x
+| Metrics - Counters, gauges and histograms    |
+| for the Mercury radio stack.                 |
+x----------------------------------------------x
+"""
+import json
+from bisect import bisect_left
+from threading import Lock
+
+################################################################################ PROGRAM DEFAULTS
+# Default histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+################################################################################ METRIC TYPES
+# Recording is a plain attribute update so that metrics can stay on in hot loops.
+# Updates from several threads may very rarely lose an increment; that is accepted.
+class Counter: # Value that only goes up
+    def __init__(self, name: str, help_text: str, labels: dict):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def get_samples(self) -> list: # (suffix, extra labels, value)
+        return [("", {}, self.value)]
+
+class Gauge: # Value that goes up and down
+    def __init__(self, name: str, help_text: str, labels: dict):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.value = 0
+
+    def set(self, v):
+        self.value = v
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def get_samples(self) -> list:
+        return [("", {}, self.value)]
+
+class Histogram: # Distribution of observed values in cumulative buckets
+    def __init__(self, name: str, help_text: str, labels: dict, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # last slot is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def get_samples(self) -> list:
+        samples = []
+        cumulative = 0
+        for i in range(len(self.buckets)):
+            cumulative += self.counts[i]
+            samples.append(("_bucket", {"le": str(self.buckets[i])}, cumulative))
+        samples.append(("_bucket", {"le": "+Inf"}, cumulative + self.counts[-1]))
+        samples.append(("_sum", {}, self.sum))
+        samples.append(("_count", {}, self.count))
+        return samples
+
+################################################################################ REGISTRY
+class Registry:
+    def __init__(self):
+        self.metrics = {} # (name, labels) -> metric, in creation order
+        self.lock = Lock()
+
+    # Get or create a metric of a type. The same name and labels always give the same object,
+    # so modules can create their metrics at import time and share them between instances.
+    def __get(self, metric_type, name: str, help_text: str, labels: dict, *args):
+        labels = labels or {}
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if(key not in self.metrics):
+                self.metrics[key] = metric_type(name, help_text, labels, *args)
+            return self.metrics[key]
+
+    def counter(self, name: str, help_text: str, labels=None) -> Counter:
+        return self.__get(Counter, name, help_text, labels)
+
+    def gauge(self, name: str, help_text: str, labels=None) -> Gauge:
+        return self.__get(Gauge, name, help_text, labels)
+
+    def histogram(self, name: str, help_text: str, labels=None, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.__get(Histogram, name, help_text, labels, buckets)
+
+    # Format label pairs as {a="b",c="d"}
+    def __format_labels(self, labels: dict) -> str:
+        if(len(labels) == 0):
+            return ""
+        pairs = []
+        for k, v in labels.items():
+            pairs.append(k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"')
+        return "{" + ",".join(pairs) + "}"
+
+    # Render every metric in the Prometheus text exposition format
+    def render_prometheus(self) -> str:
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name) # series of a name must be adjacent
+        lines = []
+        described = set()
+        for m in metrics:
+            if(m.name not in described):
+                described.add(m.name)
+                lines.append("# HELP " + m.name + " " + m.help_text)
+                lines.append("# TYPE " + m.name + " " + type(m).__name__.lower())
+            for suffix, extra, value in m.get_samples():
+                lines.append(m.name + suffix + self.__format_labels({**m.labels, **extra}) + " " + str(value))
+        return "\n".join(lines) + "\n"
+
+    # Render every metric as JSON
+    def render_json(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        out = []
+        for m in metrics:
+            entry = {"name": m.name, "type": type(m).__name__.lower(), "labels": m.labels}
+            if(isinstance(m, Histogram)):
+                entry["buckets"] = dict(zip([str(b) for b in m.buckets] + ["+Inf"], m.counts))
+                entry["sum"] = m.sum
+                entry["count"] = m.count
+            else:
+                entry["value"] = m.value
+            out.append(entry)
+        return json.dumps(out)
+
+# Registry shared by every module in the process
+REGISTRY = Registry()
+
+def counter(name: str, help_text: str, labels=None) -> Counter:
+    return REGISTRY.counter(name, help_text, labels)
+
+def gauge(name: str, help_text: str, labels=None) -> Gauge:
+    return REGISTRY.gauge(name, help_text, labels)
+
+def histogram(name: str, help_text: str, labels=None, buckets=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, help_text, labels, buckets)
@@ -0,0 +1,87 @@
+import afskmodem
+import adrcfs
+from adrcfs import NetworkInterface
+import argparse
+import cProfile
+import pstats
+import tracemalloc
+from time import perf_counter
+
+parser = argparse.ArgumentParser(description="Replay recorded transmissions (48 kHz 16-bit mono wav) through the "
+    "receive path and show where the time goes.")
+parser.add_argument("wav", nargs="+", help="recordings to replay")
+parser.add_argument("--address", help="only keep Packets addressed to this address (port 65535), as pager-rx.py does")
+parser.add_argument("--repeat", type=int, default=1, help="replay each recording this many times")
+parser.add_argument("--no-alloc", action="store_true", help="don't trace allocations (they slow decoding down)")
+parser.add_argument("--cprofile", metavar="FILE", help="also write cProfile stats to FILE "
+    "(view with snakeviz, or turn into a flamegraph with flameprof)")
+args = parser.parse_args()
+
+afskmodem.log.level = 2
+adrcfs.log.level = 2
+
+if(args.address is None):
+    ni = NetworkInterface("255.255.255.255", 65535)
+else:
+    ni = NetworkInterface(args.address, 65535)
+
+# stage -> [calls, seconds, peak bytes allocated]
+stages = {}
+last_memory = [0]
+
+# Record a stage. Its allocation is the most traced memory in use during it, above what was in
+# use when the previous stage ended (bit_slicing runs inside training_block and ecc, so its
+# allocations are counted there).
+def stage_hook(stage: str, seconds: float):
+    s = stages.setdefault(stage, [0, 0.0, 0])
+    s[0] += 1
+    s[1] += seconds
+    if(tracemalloc.is_tracing()):
+        memory, peak = tracemalloc.get_traced_memory()
+        s[2] = max(s[2], peak - last_memory[0])
+        last_memory[0] = memory
+        tracemalloc.reset_peak()
+
+ni.set_stage_hook(stage_hook)
+if(not args.no_alloc):
+    tracemalloc.start()
+profiler = None
+if(args.cprofile is not None):
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+packets = 0
+start_time = perf_counter()
+for i in range(args.repeat):
+    for filename in args.wav:
+        ni.ri.receiver.replay(filename)
+        try:
+            while(True):
+                if(args.address is None):
+                    ni.listen_for_any_packet()
+                else:
+                    ni.listen_for_packet()
+                packets += 1
+        except EOFError:
+            pass
+        finally:
+            ni.ri.receiver.close()
+total_time = perf_counter() - start_time
+
+if(profiler is not None):
+    profiler.disable()
+    profiler.dump_stats(args.cprofile)
+tracemalloc.stop()
+
+print("Decoded " + str(packets) + " packets from " + str(len(args.wav) * args.repeat) + " replays in "
+    + str(round(total_time, 3)) + " s.\n")
+print("stage".ljust(16) + "calls".rjust(8) + "total ms".rjust(12) + "mean ms".rjust(10) + "share".rjust(8) + "peak KiB".rjust(12))
+for stage, (calls, seconds, allocated) in stages.items():
+    line = stage.ljust(16) + str(calls).rjust(8) + str(round(seconds * 1000, 2)).rjust(12)
+    line += str(round(seconds * 1000 / calls, 3)).rjust(10) + (str(round(100 * seconds / total_time, 1)) + "%").rjust(8)
+    line += ("-" if args.no_alloc else str(round(allocated / 1024, 1))).rjust(12)
+    print(line)
+
+if(profiler is not None):
+    print("\nWrote cProfile stats to " + args.cprofile + ". Top functions by cumulative time:")
+    pstats.Stats(args.cprofile).sort_stats("cumulative").print_stats(15)
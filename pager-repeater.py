@@ -0,0 +1,27 @@
+from adrcfs import NetworkInterface, Repeater
+
+print("----- Mercury Pager Repeater -----")
+print("- Homepage: https://github.com/jmeifert/mercurypager")
+print("- Updates: https://github.com/jmeifert/mercurypager/releases")
+print("Enter maximum hop count (1-255). BLANK:4")
+max_hops = input(":")
+if(max_hops == ""):
+    max_hops = 4
+print("Wait for a clear channel before relaying? (Y/n)")
+carrier_sense = not input(":").lower().startswith("n")
+
+ni = NetworkInterface("255.255.255.255", 65535)
+ni.set_carrier_sense(carrier_sense)
+rp = Repeater(ni, max_hops=int(max_hops))
+
+while(True):
+    print("Listening for pages to relay...\n")
+    p = ni.listen_for_any_packet()
+    rp.handle_packet(p)
+    stats = rp.get_stats()
+    print("Relayed: " + str(stats["relayed"]) + ", Duplicates dropped: " + str(stats["dropped_duplicate"])
+     + ", Hop limit dropped: " + str(stats["dropped_ttl"]) + ", Queued: " + str(stats["queued"]))
+    if(carrier_sense):
+        csma = ni.get_csma_stats()
+        print("Channel busy: " + str(csma["deferrals"]) + " times, Waited: " + str(round(csma["wait_seconds"], 1))
+         + " s, Sent on a busy channel: " + str(csma["forced"]))
@@ -0,0 +1,79 @@
+import afskmodem
+from afskmodem import DigitalReceiver, DigitalModulationTypes
+from adrcfs import Packet, FormatUtils, parse_header, get_header_length
+from capturejournal import CaptureJournal, CAPTURE_DIR
+import argparse
+from datetime import datetime
+from time import time, perf_counter
+
+parser = argparse.ArgumentParser(description="Decode the bursts kept in a capture journal (see pager-rx.py) again, "
+    "e.g. with other receiver settings.")
+parser.add_argument("journal", nargs="?", default=CAPTURE_DIR, help="journal directory (default: " + CAPTURE_DIR + ")")
+parser.add_argument("--hours", type=float, help="only bursts from the last HOURS hours")
+parser.add_argument("--address", help="only keep Packets addressed to this address")
+parser.add_argument("--modulation", default="afsk1200", choices=DigitalModulationTypes.get_names(),
+    help="modulation type (default afsk1200)")
+parser.add_argument("--end-threshold", type=int, default=afskmodem.AMPLITUDE_END_THRESHOLD, help="amp_end_threshold")
+parser.add_argument("--deadzone", type=int, default=afskmodem.AMPLIFIER_DEADZONE, help="amp_deadzone")
+parser.add_argument("--no-agc", action="store_true", help="don't normalize bursts before demodulating them")
+parser.add_argument("--whole", action="store_true", help="run whole segments through the squelch instead of "
+    "decoding the indexed bursts (for journals that keep the whole stream)")
+args = parser.parse_args()
+
+afskmodem.log.level = 2
+receiver = DigitalReceiver(getattr(DigitalModulationTypes, args.modulation)(), amp_end_threshold=args.end_threshold,
+                           amp_deadzone=args.deadzone, automatic_gain=not args.no_agc)
+journal = CaptureJournal(args.journal)
+packed_address = None if args.address is None else bytes(FormatUtils.parse_address(args.address))
+
+# Decode a header's data length, dropping frames for other addresses
+def accept_header(header: bytes) -> int:
+    hlen, dlen, source, dest, sPort, dPort, flag, age = parse_header(header)
+    if(packed_address is not None and dest != packed_address):
+        return -1
+    return dlen
+
+def show_packet(rd: bytes, te: int, when: str):
+    p = Packet()
+    p.load(rd)
+    print(when + " " + p.get_source() + ":" + str(p.get_source_port()) + " -> " + p.get_dest() + ":" + str(p.get_dest_port())
+     + " (Integrity: " + str(round(100 * (1 - te / len(rd)), 1)) + "%): " + p.get_data().decode("ascii", "ignore"))
+
+decoded = 0
+failed = 0
+audio_bytes = 0
+start_time = perf_counter()
+if(args.whole):
+    for segment in journal.get_segments():
+        view = journal.map_segment(segment)
+        audio_bytes += len(view)
+        receiver.replay(view)
+        try:
+            while(True):
+                rd, te = receiver.rx(-1, get_header_length, accept_header)
+                if(rd == b""):
+                    failed += 1
+                else:
+                    decoded += 1
+                    show_packet(rd, te, "segment " + str(segment))
+        except EOFError:
+            pass
+        finally:
+            receiver.close()
+else:
+    since = None if args.hours is None else time() - args.hours * 3600
+    for burst in journal.get_bursts(since):
+        when = datetime.fromtimestamp(burst[0]).strftime('%Y-%m-%d %H:%M:%S')
+        view = journal.map_burst(burst)
+        audio_bytes += len(view)
+        rd, te = receiver.demodulate(view, get_header_length, accept_header)
+        if(rd == b""):
+            failed += 1
+            print(when + " nothing decoded (segment " + str(burst[1]) + ", offset " + str(burst[2]) + ")")
+        else:
+            decoded += 1
+            show_packet(rd, te, when)
+total_time = perf_counter() - start_time
+
+print("\n" + str(decoded) + " decoded, " + str(failed) + " not decoded or filtered. "
+    + str(round(audio_bytes / (2 * afskmodem.SAMPLE_RATE), 1)) + " s of audio in " + str(round(total_time, 2)) + " s.")
@@ -1,24 +1,10 @@
-from adrcfs import NetworkInterface
-
-print("----- Mercury Pager Receiver -----")
-print("- Homepage: https://github.com/jmeifert/mercurypager")
-print("- Updates: https://github.com/jmeifert/mercurypager/releases")
-print("Enter address to listen on (xxx.xxx.xxx.xxx). BLANK:ANY")
-this_addr = input(":")
-if(this_addr == ""):
-    filterListener = False
-    ni = NetworkInterface("255.255.255.255", 65535)
-else:
-    filterListener = True
-    ni = NetworkInterface(this_addr, 65535)
-
-while(True):
-    print("Listening for pages...\n")
-    if(filterListener):
-        p = ni.listen_for_packet()
-    else:
-        p = ni.listen_for_any_packet()
-    
+from adrcfs import NetworkInterface, ReceiverHost
+from pagestore import PageStore, STORE_PATH
+from capturejournal import CaptureJournal, CAPTURE_DIR
+import os
+
+# Print a received Packet (and the Packets grouped in it)
+def show_packet(p, p_integrity: float, device=None):
     # get attributes
     p_source = p.get_source()
     p_dest = p.get_dest()
@@ -28,10 +14,13 @@ while(True):
     p_flag = p.get_flag()
     p_length = p.get_length()
     p_data = p.get_data()
-    p_integrity = round(ni.get_integrity() * 100, 4)
+    p_integrity = round(p_integrity * 100, 4)
 
     # display attributes
-    print("\nPage received (Integrity: " + str(p_integrity) + "%)")
+    if(device is None):
+        print("\nPage received (Integrity: " + str(p_integrity) + "%)")
+    else:
+        print("\nPage received on " + device + " (Integrity: " + str(p_integrity) + "%)")
     if(p_integrity < 70):
         print("WARNING: Low page integrity. Uncorrectable errors may be present.")
     print(str(p_source) + ":" + str(p_source_port) + " -> " + str(p_dest) + ":" + str(p_dest_port)
@@ -40,9 +29,8 @@ while(True):
     # handle contents
     if(p.is_group_flag()):
         print("Page is a group. Showing grouped pages:")
-        gp = p.get_grouped_packets()
         # display each packet in group
-        for i in gp:
+        for i in p.iter_grouped_packets():
             i_source = i.get_source()
             i_dest = i.get_dest()
             i_source_port = i.get_source_port()
@@ -56,5 +44,66 @@ while(True):
     else:
         # if not a group print the packet's data
         print(p_data.decode("ascii", "ignore"))
-    
-    print("Done. (CTRL-C to exit)")
\ No newline at end of file
+
+    print("Done. (CTRL-C to exit)")
+
+def main():
+    print("----- Mercury Pager Receiver -----")
+    print("- Homepage: https://github.com/jmeifert/mercurypager")
+    print("- Updates: https://github.com/jmeifert/mercurypager/releases")
+    print("Enter address to listen on (xxx.xxx.xxx.xxx). BLANK:ANY")
+    this_addr = input(":")
+    print("Enter input devices to listen on, separated by commas (name or number). BLANK:DEFAULT")
+    devices = [d.strip() for d in input(":").split(",") if d.strip() != ""]
+    print("Store received pages in " + STORE_PATH + " for pager-search.py? (y/N)")
+    store = None
+    if(input(":").lower().startswith("y")):
+        store = PageStore(STORE_PATH)
+    print("Keep the audio of every burst in " + CAPTURE_DIR + "/ for pager-replay.py? (y/N)")
+    capture = input(":").lower().startswith("y")
+
+    if(len(devices) > 0):
+        # Receive on every device at once
+        if(this_addr == ""):
+            host = ReceiverHost(devices)
+        else:
+            host = ReceiverHost(devices, this_addr, 65535)
+        if(capture):
+            for device, receiver in host.receivers.items():
+                receiver.capture = CaptureJournal(os.path.join(CAPTURE_DIR, "".join(c if c.isalnum() else "_" for c in device)))
+        host.start()
+        print("Listening for pages on " + ", ".join(devices) + "...\n")
+        try:
+            while(True):
+                device, p, p_integrity = host.get()
+                if(store is not None):
+                    store.add(p, p_integrity, device)
+                show_packet(p, p_integrity, device)
+        except KeyboardInterrupt:
+            host.stop()
+            for device, stats in host.get_stats().items():
+                print(device + ": " + str(stats["packets"]) + " pages, " + str(stats["bursts"]) + " bursts, "
+                 + str(stats["dropped"]) + " dropped, " + str(stats["errors"]) + " errors")
+    else:
+        if(this_addr == ""):
+            filterListener = False
+            ni = NetworkInterface("255.255.255.255", 65535)
+        else:
+            filterListener = True
+            ni = NetworkInterface(this_addr, 65535)
+        if(capture):
+            ni.ri.receiver.capture = CaptureJournal(CAPTURE_DIR)
+
+        while(True):
+            print("Listening for pages...\n")
+            if(filterListener):
+                p = ni.listen_for_packet()
+            else:
+                p = ni.listen_for_any_packet()
+            if(store is not None):
+                store.add(p, ni.get_integrity())
+            show_packet(p, ni.get_integrity())
+
+# Decoding processes import this script, so only run it when started directly
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+from pagestore import PageStore, STORE_PATH
+from adrcfs import FormatUtils
+from datetime import datetime
+from time import time
+import os
+
+print("----- Mercury Pager Search -----")
+print("- Homepage: https://github.com/jmeifert/mercurypager")
+print("- Updates: https://github.com/jmeifert/mercurypager/releases")
+if(not os.path.exists(STORE_PATH)):
+    print("No pages stored yet (" + STORE_PATH + " not found). Turn on storing in pager-rx.py.")
+    exit()
+store = PageStore(STORE_PATH)
+print(str(store.count()) + " pages stored.")
+
+# Ask for an address, returning None for any
+def input_address(prompt: str):
+    while(True):
+        print(prompt + " (xxx.xxx.xxx.xxx). BLANK:ANY")
+        a = input(":")
+        if(a == ""):
+            return None
+        if(FormatUtils.is_valid_address(a)):
+            return a
+        print("Invalid address.")
+
+while(True):
+    print("\nEnter words to search for (e.g. fire station, evac*, \"exact phrase\"). BLANK:ANY")
+    text = input(":")
+    source = input_address("Enter source address")
+    dest = input_address("Enter destination address")
+    print("Enter how many hours back to search. BLANK:ALL")
+    hours = input(":")
+    since = None
+    if(hours != ""):
+        since = time() - float(hours) * 3600
+
+    try:
+        results = store.search(text if text != "" else None, source, dest, since)
+    except Exception as e:
+        print("Search failed: " + str(e))
+        continue
+    print("\n" + str(len(results)) + " pages found (newest first):")
+    for r in results:
+        pid, received, r_source, r_source_port, r_dest, r_dest_port, flag, age, integrity, device, parent, data = r
+        header = datetime.fromtimestamp(received).strftime('%Y-%m-%d %H:%M:%S') + " " + r_source + ":" + str(r_source_port) + " -> " + r_dest + ":" + str(r_dest_port)
+        header += " (A: " + str(age) + ", F: " + flag + ", I: " + str(round(integrity * 100, 1)) + "%"
+        if(device is not None):
+            header += ", on " + device
+        if(parent is not None):
+            header += ", in group #" + str(parent)
+        print("#" + str(pid) + " " + header + "):")
+        print(data.decode("ascii", "ignore"))
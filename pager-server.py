@@ -4,156 +4,1062 @@ import smtplib
 from email.header import decode_header
 from email.mime.text import MIMEText
 import email
-from time import sleep
+from time import sleep, monotonic, time, perf_counter
+import select
+import ssl
+import re
+import base64
+import quopri
+import asyncio
+import json
+import socket
+import sqlite3
+import itertools
+from collections import deque
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from adrcfs import NetworkInterface, FormatUtils
+from afskmodem import DigitalModulationTypes
+import metrics
+import mercurylog
 import os
 
 ################################################################ USER CONSTANTS (Read from configuration file)
+# Settings are KEY=value lines. Settings added since the first release have defaults, so
+# that older configuration files keep working.
 with open("mercury.conf","r") as f:
-    config_lines = []
+    config = {}
     for i in f.readlines():
-        if(i[0] != "#" and i[0] != " "):
-            config_lines.append(i.split("=")[1].strip("\n"))
-
-IMAP_ADDR = config_lines[0]
-IMAP_SERVER = config_lines[1]
-IMAP_PORT = int(config_lines[2])
-IMAP_PASSWORD = config_lines[3]
-SMTP_ADDR = config_lines[4]
-SMTP_SERVER = config_lines[5]
-SMTP_PORT = int(config_lines[6])
-SMTP_PASSWORD = config_lines[7]
-SOURCE_ADDRESS = config_lines[8]
-PAGE_COOLDOWN = int(config_lines[9])
-MAX_PAGE_LENGTH = int(config_lines[10])
-OUTGOING_MESSAGE_SUBJECT = config_lines[11]
-OUTGOING_MESSAGE_HEADER = config_lines[12] + "\n"
+        if(i[0] != "#" and i[0] != " " and "=" in i):
+            key, value = i.split("=", 1)
+            config[key.strip()] = value.strip("\n")
+
+IMAP_ADDR = config["IMAP_ADDR"]
+IMAP_SERVER = config["IMAP_SERVER"]
+IMAP_PORT = int(config["IMAP_PORT"])
+IMAP_PASSWORD = config["IMAP_PASSWORD"]
+SMTP_ADDR = config["SMTP_ADDR"]
+SMTP_SERVER = config["SMTP_SERVER"]
+SMTP_PORT = int(config["SMTP_PORT"])
+SMTP_PASSWORD = config["SMTP_PASSWORD"]
+SOURCE_ADDRESS = config["SOURCE_ADDRESS"]
+PAGE_COOLDOWN = int(config["PAGE_COOLDOWN"])
+MAX_PAGE_LENGTH = int(config["MAX_PAGE_LENGTH"])
+OUTGOING_MESSAGE_SUBJECT = config["OUTGOING_MESSAGE_SUBJECT"]
+OUTGOING_MESSAGE_HEADER = config["OUTGOING_MESSAGE_HEADER"] + "\n"
+TX_DUTY_CYCLE = float(config.get("TX_DUTY_CYCLE", "0.5"))
+TX_DUTY_WINDOW = float(config.get("TX_DUTY_WINDOW", "60"))
+URGENT_TAG = config.get("URGENT_TAG", "URGENT")
+CARRIER_SENSE = config.get("CARRIER_SENSE", "0").lower() in ("1", "true", "yes")
+COMPACT_HEADERS = config.get("COMPACT_HEADERS", "0").lower() in ("1", "true", "yes")
+TX_RADIOS = config.get("TX_RADIOS", "").strip()
 
 ################################################################################ LOGGING
-def get_date_and_time(): # Long date and time for logging
+def get_date_and_time(): # Long date and time for confirmations
         now = datetime.now()
         return now.strftime('%Y-%m-%d %H:%M:%S')
 
 # Logging level (0: INFO, 1: WARN (recommended), 2: ERROR, 3: NONE)
 LOG_LEVEL = 0
 #
-# Should the log output to the console?
-LOG_TO_CONSOLE = True
-#
-# Should the log output to a log file?
-LOG_TO_FILE = False
-#
-# Where to generate logfile if need be
-LOG_PATH = "mercury.log"
-#
-# How the log identifies which module is logging.
+# How the log identifies which module is logging. (Log output is configured in mercurylog.py)
 LOG_PREFIX = "(Mercury)"
 
-# Initialize log file if needed
-if(LOG_TO_FILE):
-    try:
-        os.remove(LOG_PATH)
-    except:
-        pass
-    with open(LOG_PATH, "w") as f:
-        f.write(get_date_and_time() + " [INFO] " + LOG_PREFIX + " Logging initialized.\n")
-
-def log(level: int, data: str):
-    if(level >= LOG_LEVEL):
-        output = get_date_and_time()
-        if(level == 0):
-            output += " [INFO] "
-        elif(level == 1):
-            output += " [WARN] "
-        else:
-            output += " [ERR!] "
-        output += LOG_PREFIX + " "
-        output += data
-        if(LOG_TO_FILE):
-            with open(LOG_PATH, "a") as f:
-                f.write(output + "\n")
-        if(LOG_TO_CONSOLE):
-            print(output)
+log = mercurylog.get_logger(LOG_PREFIX, LOG_LEVEL)
+
+################################################################################ Metrics
+PAGES_ACCEPTED_MAIL = metrics.counter("mercury_pages_accepted_total", "Pages accepted for transmission", {"source": "mail"})
+PAGES_ACCEPTED_LOCAL = metrics.counter("mercury_pages_accepted_total", "Pages accepted for transmission", {"source": "local"})
+PAGES_TRANSMITTED = metrics.counter("mercury_pages_transmitted_total", "Pages transmitted")
+TRANSMIT_ERRORS = metrics.counter("mercury_transmit_errors_total", "Pages that failed to transmit")
+CONFIRMATIONS_SENT = metrics.counter("mercury_confirmations_sent_total", "Confirmation mails sent")
+CONFIRMATION_ERRORS = metrics.counter("mercury_confirmation_errors_total", "Confirmation mails that could not be sent")
+QUEUE_DEPTH = metrics.gauge("mercury_queue_depth", "Pages waiting to be transmitted")
+PAGE_LATENCY = metrics.histogram("mercury_page_latency_seconds", "Time from mail arrival (or local submission) to the end of transmission")
+PAGE_AIRTIME = metrics.histogram("mercury_page_airtime_seconds", "Measured airtime per page")
+INGEST_SECONDS = metrics.histogram("mercury_ingest_seconds", "Time to fetch a batch of mail")
 
 ################################################################################ IMAP Tools
+# Seconds to stay in IDLE before renewing it (servers drop IDLE after ~30 minutes)
+IMAP_IDLE_TIMEOUT = 300
+#
+# Seconds between NOOP polls when the server doesn't support IDLE
+IMAP_POLL_INTERVAL = 3
+#
+# Longest wait in seconds between reconnection attempts
+IMAP_MAX_BACKOFF = 300
+#
+# Seconds to wait for the server while connecting and logging in
+IMAP_CONNECT_TIMEOUT = 30
+
 class IMAP:
     def __init__(self, useremail, password, server, port):
         self.useremail = useremail
         self.password = password
         self.server = server
         self.port = port
+        self.imap = None
+        self.idle_supported = False
+        self.backoff = 1
+        self.stopping = threading.Event()
+
+    # Open a session if there isn't one, retrying with exponential backoff until stop() is called
+    def connect(self):
+        while(self.imap is None):
+            if(self.stopping.is_set()):
+                raise imaplib.IMAP4.abort("shutting down")
+            try:
+                self.imap = imaplib.IMAP4_SSL(self.server, self.port, timeout=IMAP_CONNECT_TIMEOUT)
+                self.imap.login(self.useremail, self.password)
+                self.imap.select("INBOX")
+                self.imap.sock.settimeout(None) # IDLE waits with select() instead
+                if(self.stopping.is_set()): # stop() came too early to close this session
+                    raise imaplib.IMAP4.abort("shutting down")
+                self.idle_supported = "IDLE" in self.imap.capabilities
+                self.backoff = 1
+                log(0, "Connected to IMAP server (IDLE %s).", "supported" if self.idle_supported else "not supported")
+            except Exception as e:
+                self.disconnect()
+                log(1, "IMAP connection failed: %s. Retrying in %ss.", e, self.backoff)
+                self.stopping.wait(self.backoff)
+                self.backoff = min(self.backoff * 2, IMAP_MAX_BACKOFF)
+
+    # Drop the session (it is reopened on next use)
+    def disconnect(self):
+        if(self.imap is not None):
+            try:
+                self.imap.logout()
+            except Exception:
+                pass
+        self.imap = None
 
-    def getMessageCount(self):
-        self.imap = imaplib.IMAP4_SSL(self.server, self.port)
-        self.imap.login(self.useremail, self.password)
-
-        status, messages = self.imap.select("INBOX")
-
-        self.imap.close()
-        self.imap.logout()
-        return int(messages[0])
-
-    def read(self, index, remove=False):
-        # Open connection
-        self.imap = imaplib.IMAP4_SSL(self.server, self.port)
-        self.imap.login(self.useremail, self.password)
-        self.imap.select("INBOX")
-        # Read the message
-        res, msg = self.imap.fetch(str(index), "(RFC822)")
-        for response in msg:
-            if isinstance(response, tuple):
-                msg = email.message_from_bytes(response[1])
-                message_subject, encoding = decode_header(msg["Subject"])[0]
-                if isinstance(message_subject, bytes):
-                    message_subject = message_subject.decode(encoding)
-                
-                message_from, encoding = decode_header(msg.get("From"))[0]
-                if isinstance(message_from, bytes):
-                    message_from = message_from.decode(encoding)
-                if("<" in message_from):
-                    message_from = message_from.split("<")[1].strip(">")
-            if msg.is_multipart():
-                for part in msg.walk():       
-                    if part.get_content_type() == "text/plain":
-                        message_body = part.get_payload(decode=True).decode()
-            
+    # Stop reconnecting and close the socket under a blocked call so that it returns (used on shutdown)
+    def stop(self):
+        self.stopping.set()
+        if(self.imap is not None):
+            try:
+                self.imap.shutdown()
+            except Exception:
+                pass
+
+    # Run an operation on the session, dropping the session if it fails so the next call reconnects
+    def __run(self, operation):
+        self.connect()
+        try:
+            return operation()
+        except Exception:
+            self.disconnect()
+            raise
+
+    # Is a complete line already in imaplib's read buffer? (select() only sees the socket)
+    def __line_buffered(self) -> bool:
+        self.imap.sock.setblocking(False)
+        try:
+            return b"\n" in self.imap.file.peek()
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return False # nothing buffered and nothing more on the socket yet
+        finally:
+            self.imap.sock.setblocking(True)
+
+    # Wait for an untagged line from the server for up to timeout seconds (None if nothing arrived)
+    def __read_line(self, timeout: float):
+        if(not self.__line_buffered() and self.imap.sock.pending() == 0):
+            ready, _, _ = select.select([self.imap.sock], [], [], timeout)
+            if(len(ready) == 0):
+                return None
+        line = self.imap.readline()
+        if(line == b""):
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        return line
+
+    # Sit in IDLE until the server reports new mail or the timeout passes. Returns True on new mail.
+    # EXISTS may arrive at any point, even before the server has confirmed IDLE or after DONE.
+    def __idle(self, timeout: float) -> bool:
+        tag = self.imap._new_tag()
+        self.imap.send(tag + b" IDLE\r\n")
+        new_mail = False
+        while(True):
+            line = self.imap.readline()
+            if(line == b"" or line.startswith(tag)):
+                raise imaplib.IMAP4.error("server refused IDLE")
+            if(line.startswith(b"+")):
+                break
+            new_mail = new_mail or (line.startswith(b"*") and b"EXISTS" in line)
+        deadline = monotonic() + timeout
+        while(not new_mail and monotonic() < deadline):
+            line = self.__read_line(deadline - monotonic())
+            if(line is None):
+                break
+            new_mail = line.startswith(b"*") and b"EXISTS" in line
+        self.imap.send(b"DONE\r\n")
+        while(True):
+            line = self.imap.readline()
+            if(line == b""):
+                raise imaplib.IMAP4.abort("connection closed during IDLE")
+            if(line.startswith(tag)):
+                break
+            new_mail = new_mail or (line.startswith(b"*") and b"EXISTS" in line)
+        return new_mail
+
+    # Poll with NOOP. Returns True if the server reported new mail.
+    def __poll(self, timeout: float) -> bool:
+        self.stopping.wait(min(timeout, IMAP_POLL_INTERVAL))
+        self.imap.untagged_responses.pop("EXISTS", None) # left over from select() and earlier commands
+        self.imap.noop()
+        return self.imap.response("EXISTS")[1] != [None]
+
+    # Block until new mail may have arrived, or timeout seconds pass
+    def wait(self, timeout=IMAP_IDLE_TIMEOUT) -> bool:
+        def operation():
+            if(self.idle_supported):
+                return self.__idle(timeout)
+            return self.__poll(timeout)
+        return self.__run(operation)
+
+    # Join a FETCH response (with literals split out by imaplib) into one line per message,
+    # inlining each literal as a quoted string
+    def __join_fetch_response(self, data: list) -> list:
+        lines = []
+        continued = False
+        for item in data:
+            if item is None:
+                continue
+            if isinstance(item, tuple):
+                literal = item[1].replace(b"\\", b"\\\\").replace(b'"', b'\\"')
+                piece = item[0][:item[0].rfind(b"{")] + b'"' + literal + b'"'
+            else:
+                piece = item
+            if(continued):
+                lines[-1] += piece
+            else:
+                lines.append(piece)
+            continued = isinstance(item, tuple)
+        return lines
+
+    # Parse an IMAP parenthesised list into nested lists (NIL becomes None)
+    def __parse_list(self, data: bytes):
+        stack = [[]]
+        for token in re.findall(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"\[]+(?:\[[^\]]*\])?(?:<\d+>)?', data):
+            if(token == b"("):
+                stack.append([])
+            elif(token == b")"):
+                done = stack.pop()
+                stack[-1].append(done)
+            elif(token.startswith(b'"')):
+                stack[-1].append(re.sub(rb'\\(.)', rb'\1', token[1:-1]))
+            elif(token.upper() == b"NIL"):
+                stack[-1].append(None)
             else:
-                if msg.get_content_type() == "text/plain":
-                    message_body = msg.get_payload(decode=True).decode("ascii", "ignore")
-        if(remove):
-            self.imap.store(str(index), '+FLAGS', '\\Deleted')
+                stack[-1].append(token)
+        return stack[0]
+
+    # Run a UID FETCH and return {uid: {item name: value}}
+    def __fetch(self, uids: list, items: str) -> dict:
+        res, data = self.imap.uid("FETCH", ",".join(str(u) for u in uids), items)
+        messages = {}
+        for line in self.__join_fetch_response(data):
+            parsed = self.__parse_list(line)
+            attributes = parsed[-1]
+            fields = {}
+            for i in range(0, len(attributes) - 1, 2):
+                fields[attributes[i].upper().decode()] = attributes[i + 1]
+            messages[int(fields["UID"])] = fields
+        return messages
+
+    # Find the first text/plain part in a BODYSTRUCTURE. Returns (section, encoding, charset) or None.
+    def __find_text_part(self, structure: list, section=""):
+        if(len(structure) > 0 and isinstance(structure[0], list)): # multipart
+            n = 1
+            for part in structure:
+                if(not isinstance(part, list)):
+                    break
+                found = self.__find_text_part(part, section + str(n) + ".")
+                if(found is not None):
+                    return found
+                n += 1
+            return None
+        if(structure[0].lower() != b"text" or structure[1].lower() != b"plain"):
+            return None
+        charset = "utf-8"
+        params = structure[2] or []
+        for i in range(0, len(params) - 1, 2):
+            if(params[i].lower() == b"charset"):
+                charset = params[i + 1].decode()
+        if(section == ""):
+            section = "TEXT"
+        return section.rstrip("."), structure[5].lower().decode(), charset
+
+    # Octets of a part to fetch so that MAX_PAGE_LENGTH bytes survive transfer decoding
+    def __partial_length(self, encoding: str) -> int:
+        if(encoding == "base64"):
+            n = MAX_PAGE_LENGTH * 4 // 3 + 4
+            return n + (n // 76 + 1) * 2
+        if(encoding == "quoted-printable"):
+            n = MAX_PAGE_LENGTH * 3
+            return n + (n // 75 + 1) * 3
+        return MAX_PAGE_LENGTH
+
+    # Decode a (possibly cut short) part body to text no longer than MAX_PAGE_LENGTH bytes
+    def __decode_partial(self, data: bytes, encoding: str, charset: str) -> str:
+        if(encoding == "base64"):
+            data = re.sub(rb"\s", b"", data)
+            data = base64.b64decode(data[:len(data) - len(data) % 4])
+        elif(encoding == "quoted-printable"):
+            data = re.sub(rb"=[0-9A-Fa-f]?$", b"", data)
+            data = quopri.decodestring(data)
+        try:
+            return data[:MAX_PAGE_LENGTH].decode(charset, "ignore")
+        except LookupError:
+            return data[:MAX_PAGE_LENGTH].decode("ascii", "ignore")
+
+    # Fetch every pending message, oldest first, as a list of (uid, from, subject, body, arrival
+    # time as a UNIX timestamp). Only the structure, the From/Subject headers and the first
+    # MAX_PAGE_LENGTH bytes of the text/plain part are downloaded, however large the message is.
+    def read_pending(self) -> list:
+        return self.__run(self.__read_pending)
+
+    def __read_pending(self) -> list:
+        res, data = self.imap.uid("SEARCH", None, "UNDELETED")
+        uids = sorted(int(u) for u in data[0].split())
+        if(len(uids) == 0):
+            return []
+        structures = self.__fetch(uids, "(UID BODYSTRUCTURE INTERNALDATE)")
+        headers = self.__fetch(uids, "(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])")
+        # Group messages by which part to fetch so that each group takes one FETCH
+        parts = {}
+        groups = {}
+        for uid in uids:
+            part = self.__find_text_part(structures[uid]["BODYSTRUCTURE"])
+            parts[uid] = part
+            if(part is not None):
+                item = "BODY.PEEK[" + part[0] + "]<0." + str(self.__partial_length(part[1])) + ">"
+                groups.setdefault(item, []).append(uid)
+        bodies = {}
+        for item, group_uids in groups.items():
+            for uid, fields in self.__fetch(group_uids, "(UID " + item + ")").items():
+                for name, value in fields.items():
+                    if(name.startswith("BODY[")):
+                        bodies[uid] = value or b""
+        messages = []
+        for uid in uids:
+            header = [v for k, v in headers[uid].items() if k.startswith("BODY[")][0]
+            msg = email.message_from_bytes(header)
+            message_subject, encoding = decode_header(msg["Subject"] or "")[0]
+            if isinstance(message_subject, bytes):
+                message_subject = message_subject.decode(encoding or "ascii", "ignore")
+            message_from, encoding = decode_header(msg.get("From"))[0]
+            if isinstance(message_from, bytes):
+                message_from = message_from.decode(encoding or "ascii", "ignore")
+            if("<" in message_from):
+                message_from = message_from.split("<")[1].strip(">")
+            message_body = ""
+            if(parts[uid] is not None and uid in bodies):
+                message_body = self.__decode_partial(bodies[uid], parts[uid][1], parts[uid][2])
+            try:
+                arrival_time = datetime.strptime(structures[uid]["INTERNALDATE"].decode(), "%d-%b-%Y %H:%M:%S %z").timestamp()
+            except Exception:
+                arrival_time = time()
+            messages.append((uid, message_from, message_subject, message_body, arrival_time))
+        return messages
+
+    # Delete messages by UID with a single STORE and EXPUNGE
+    def remove(self, uids: list):
+        if(len(uids) == 0):
+            return
+        def operation():
+            self.imap.uid("STORE", ",".join(str(u) for u in uids), "+FLAGS", "(\\Deleted)")
             self.imap.expunge()
-        
-        # Close connection
-        self.imap.close()
-        self.imap.logout()
-        return message_from, message_subject, message_body
-    
-    def read_last(self, remove=False):
-        lm = self.getMessageCount()
-        return self.read(lm, remove)
+        self.__run(operation)
 
 ################################################################################ SMTP Tools
+# Attempts at sending a message before giving up on it
+SMTP_SEND_ATTEMPTS = 3
+
 class SMTP:
     def __init__(self, useremail, password, server, port):
         self.useremail = useremail
         self.password = password
         self.server = server
         self.port = port
+        self.smtp = None
 
-    def send(self, recipient, subject, message):
-        self.smtp = smtplib.SMTP(self.server, self.port)
-        self.smtp.ehlo()
-        self.smtp.starttls()
-        self.smtp.login(self.useremail, self.password)
+    # Open an authenticated session if there isn't one
+    def connect(self):
+        if(self.smtp is None):
+            self.smtp = smtplib.SMTP(self.server, self.port)
+            self.smtp.ehlo()
+            self.smtp.starttls()
+            self.smtp.login(self.useremail, self.password)
+
+    # Drop the session (it is reopened on next use)
+    def disconnect(self):
+        if(self.smtp is not None):
+            try:
+                self.smtp.quit()
+            except Exception:
+                pass
+        self.smtp = None
 
+    def send(self, recipient, subject, message):
         msg = MIMEText(message)
         msg['Subject'] = subject
         msg['From'] = self.useremail
         msg['To'] = recipient
-        self.smtp.sendmail(self.useremail, recipient, msg.as_string())
+        for attempt in range(SMTP_SEND_ATTEMPTS):
+            try:
+                self.connect()
+                self.smtp.sendmail(self.useremail, recipient, msg.as_string())
+                return
+            except Exception as e:
+                self.disconnect()
+                if(attempt == SMTP_SEND_ATTEMPTS - 1):
+                    raise
+                log(1, "SMTP send failed: %s. Reconnecting.", e)
+                sleep(2 ** attempt)
+
+################################################################################ Scheduling
+# Page priority classes (lower is sent first)
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+#
+# Seconds between checks of the queue while waiting for transmit budget
+SCHEDULER_RECHECK_TIME = 0.5
+
+class DutyCycleScheduler: # Rolling transmit duty-cycle budget
+    def __init__(self, duty_cycle: float, window: float):
+        self.window = window
+        self.budget = duty_cycle * window # seconds of airtime allowed per window
+        self.history = deque() # (end time, airtime) of recent transmissions, oldest first
+
+    # Forget transmissions that ended before the window
+    def __expire(self, now: float):
+        while(len(self.history) > 0 and self.history[0][0] <= now - self.window):
+            self.history.popleft()
+
+    # Record a transmission that just ended
+    def record(self, airtime: float):
+        now = monotonic()
+        self.__expire(now)
+        self.history.append((now, airtime))
+
+    # Get the airtime used in the current window
+    def get_used(self) -> float:
+        self.__expire(monotonic())
+        return sum(h[1] for h in self.history)
+
+    # Seconds until a transmission of the given airtime fits the budget (0 if it fits now).
+    # A page longer than the whole budget is let through once the window is empty.
+    def get_delay(self, airtime: float) -> float:
+        now = monotonic()
+        self.__expire(now)
+        used = sum(h[1] for h in self.history)
+        delay = 0
+        for end_time, h_airtime in self.history:
+            if(used + airtime <= self.budget):
+                break
+            # Wait for this transmission to leave the window
+            used -= h_airtime
+            delay = end_time + self.window - now
+        return max(0, delay)
+
+################################################################################ Transmitter pool
+# Radios are listed in the TX_RADIOS file (see mercury.conf) as a JSON list of objects:
+#   name          what the log and metrics call the radio (default: radio0, radio1...)
+#   device        name or index of the sound card to transmit on (default: system default)
+#   input_device  sound card to sense the channel on (default: system default). With several
+#                 radios, a radio without one transmits without carrier sense, since the
+#                 default input is not its receiver.
+#   modulation    an afskmodem.DigitalModulationTypes name (default: afsk1200)
+#   duty_cycle    most time spent transmitting, as a fraction of TX_DUTY_WINDOW (default: TX_DUTY_CYCLE)
+#   destinations  addresses whose pages are sent on this radio (or another radio listing them)
+# Pages for any other address, including broadcasts, are sent on the least loaded radio.
+
+class Radio: # A transmitter in the pool, with its own duty-cycle budget
+    def __init__(self, name: str, ni: NetworkInterface, duty: DutyCycleScheduler, destinations: list):
+        self.name = name
+        self.ni = ni
+        self.duty = duty
+        self.destinations = destinations
+        self.executor = ThreadPoolExecutor(1) # the radio's transmissions block, so each gets its own thread
+        self.tx_pages = None # asyncio.Queue of pages handed to the radio, made by main() in the event loop
+        self.busy = False # a page was handed to the radio and hasn't been sent yet
+        self.page = None # page being transmitted and journaled by transmit()
+        self.duty_used = metrics.gauge("mercury_duty_cycle_used", "Fraction of the transmit duty-cycle budget in use", {"radio": name})
+        self.pages_sent = metrics.counter("mercury_radio_pages_transmitted_total", "Pages transmitted per radio", {"radio": name})
+
+    # Seconds until the page fits the radio's budget (0 if it fits now), or None while the radio is busy
+    def get_delay(self, page) -> float:
+        self.duty_used.set(self.duty.get_used() / self.duty.budget)
+        if(self.busy):
+            return None
+        return self.duty.get_delay(self.ni.est_tx_time(page.packet))
+
+    # Fraction of the radio's budget that would be in use after sending the page
+    def get_load(self, page) -> float:
+        return (self.duty.get_used() + self.ni.est_tx_time(page.packet)) / self.duty.budget
+
+class TransmitterPool: # Routes pages to radios
+    def __init__(self, radios: list):
+        self.radios = radios
+        self.routes = {} # destination address -> radios listing it
+        for radio in radios:
+            for dest in radio.destinations:
+                self.routes.setdefault(dest, []).append(radio)
+
+    # Pick a radio to send a page on now: the least loaded of those that are idle and have room
+    # for it, among the radios its destination is routed to (any radio if it isn't). Returns
+    # (radio, 0), or (None, seconds until one has room) with None seconds if all are busy.
+    def choose(self, page):
+        best = None
+        best_load = 0
+        wait = None
+        for radio in self.routes.get(page.packet.get_dest(), self.radios):
+            delay = radio.get_delay(page)
+            if(delay is None):
+                continue
+            if(delay > 0):
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            load = radio.get_load(page)
+            if(best is None or load < best_load):
+                best = radio
+                best_load = load
+        if(best is not None):
+            return best, 0
+        return None, wait
+
+    # Is any radio free to take a page?
+    def has_idle(self) -> bool:
+        return any(not radio.busy for radio in self.radios)
 
-        self.smtp.quit()
+    # Get the number of pages handed to radios but not yet being sent
+    def get_pending(self) -> int:
+        return sum(radio.tx_pages.qsize() for radio in self.radios if radio.tx_pages is not None)
+
+    # Wait for the pages being transmitted to finish
+    def shutdown(self):
+        for radio in self.radios:
+            radio.executor.shutdown(wait=True)
+
+# Make the pool from the TX_RADIOS file, or one radio on the system default sound cards if
+# there is none
+def load_pool(path: str) -> TransmitterPool:
+    entries = [{}]
+    if(path != ""):
+        with open(path, "r") as f:
+            entries = json.load(f)
+    radios = []
+    for i, entry in enumerate(entries):
+        name = str(entry.get("name", "radio" + str(i)))
+        modulation = entry.get("modulation", "afsk1200")
+        if(modulation not in DigitalModulationTypes.get_names()):
+            raise ValueError("Radio " + name + " has an unknown modulation " + repr(modulation))
+        destinations = entry.get("destinations", [])
+        for dest in destinations:
+            if(not FormatUtils.is_valid_address(dest)):
+                raise ValueError("Radio " + name + " has an invalid destination " + repr(dest))
+        rni = NetworkInterface(SOURCE_ADDRESS, 65535, getattr(DigitalModulationTypes, modulation)(),
+                               entry.get("input_device"), entry.get("device"))
+        carrier_sense = CARRIER_SENSE
+        if(carrier_sense and len(entries) > 1 and entry.get("input_device") is None):
+            log(1, "Radio %s has no input_device, so it transmits without carrier sense.", name)
+            carrier_sense = False
+        rni.set_carrier_sense(carrier_sense)
+        rni.set_compact_headers(COMPACT_HEADERS)
+        duty = DutyCycleScheduler(float(entry.get("duty_cycle", TX_DUTY_CYCLE)), TX_DUTY_WINDOW)
+        radios.append(Radio(name, rni, duty, destinations))
+        log(0, "Radio %s: %s on %s, %d routed destination(s).", name, modulation,
+            entry.get("device", "the default output device"), len(destinations))
+    return TransmitterPool(radios)
+
+################################################################################ Page journal
+# Where accepted pages are journaled until they are sent and confirmed
+JOURNAL_PATH = "mercury-journal.db"
+#
+# Page states in the journal
+PAGE_QUEUED = 0
+PAGE_TRANSMITTED = 1
+PAGE_CONFIRMED = 2
+
+class PageJournal: # Durable record of accepted pages (SQLite in WAL mode)
+    def __init__(self, path: str):
+        # Only ever used from one thread at a time (the journal executor)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL") # fsync on every commit
+        self.db.execute("""CREATE TABLE IF NOT EXISTS pages (
+            id INTEGER PRIMARY KEY,
+            state INTEGER NOT NULL,
+            priority INTEGER NOT NULL,
+            mail_from TEXT NOT NULL,
+            dest TEXT NOT NULL,
+            page_body TEXT NOT NULL,
+            sent_time TEXT NOT NULL DEFAULT '',
+            arrival_time REAL NOT NULL DEFAULT 0,
+            mail_uid INTEGER)""")
+        # Journals from before arrival times and mail UIDs were kept
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(pages)")]
+        if("arrival_time" not in columns):
+            self.db.execute("ALTER TABLE pages ADD COLUMN arrival_time REAL NOT NULL DEFAULT 0")
+        if("mail_uid" not in columns):
+            self.db.execute("ALTER TABLE pages ADD COLUMN mail_uid INTEGER")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pages_state ON pages (state, priority, id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pages_mail_uid ON pages (mail_uid) WHERE mail_uid IS NOT NULL")
+        self.__prune()
+        self.db.commit()
+
+    # Delete confirmed pages. A page's IMAP UID (mail_uid) is kept until its mail is removed
+    # from the server, and the page with it, so that mail whose removal failed isn't paged twice.
+    def __prune(self):
+        self.db.execute("DELETE FROM pages WHERE state = ? AND mail_uid IS NULL", (PAGE_CONFIRMED,))
+
+    # Journal a batch of pages as queued in one transaction, setting their journal ids
+    def add(self, pages: list):
+        with self.db:
+            for page in pages:
+                cur = self.db.execute("INSERT INTO pages (state, priority, mail_from, dest, page_body, arrival_time, mail_uid) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (PAGE_QUEUED, page.priority, page.mail_from, page.packet.get_dest(), page.page_body, page.arrival_time, page.mail_uid))
+                page.journal_id = cur.lastrowid
+
+    # Set the state of a batch of pages in one transaction. Confirmed pages are deleted.
+    def set_state(self, pages: list, state: int):
+        with self.db:
+            self.db.executemany("UPDATE pages SET state = ?, sent_time = ? WHERE id = ?",
+                [(state, page.sent_time, page.journal_id) for page in pages])
+            if(state == PAGE_CONFIRMED):
+                self.__prune()
+
+    # Get the UIDs of mail that was journaled as pages but may still be on the server
+    def get_mail_uids(self) -> set:
+        return set(row[0] for row in self.db.execute("SELECT mail_uid FROM pages WHERE mail_uid IS NOT NULL"))
+
+    # Record that mail was removed from the server
+    def forget_mail_uids(self, uids: list):
+        with self.db:
+            self.db.executemany("UPDATE pages SET mail_uid = NULL WHERE mail_uid = ?", [(uid,) for uid in uids])
+            self.__prune()
+
+    # Get the journal rows for pages in a state, most urgent and oldest first
+    def get(self, state: int) -> list:
+        return self.db.execute("SELECT id, priority, mail_from, dest, page_body, sent_time, arrival_time FROM pages WHERE state = ? ORDER BY priority, id",
+            (state,)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+################################################################################ Server tasks
+# Seconds to collect confirmations to the same sender into a single message
+SMTP_COALESCE_TIME = 5
+
+page_sequence = itertools.count() # Keeps pages of equal priority in arrival order
+
+class Page: # A page accepted for transmission
+    def __init__(self, mail_from: str, packet, page_body: str, priority=PRIORITY_NORMAL):
+        self.mail_from = mail_from
+        self.packet = packet
+        self.page_body = page_body
+        self.priority = priority
+        self.sequence = next(page_sequence)
+        self.sent_time = ""
+        self.journal_id = None
+        self.mail_uid = None # IMAP UID of the mail the page came from
+        self.arrival_time = time() # when the page reached us (or its mail reached the mail server)
+
+    def __lt__(self, other): # Most urgent first, then oldest first
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+# Build a Page, trimming its body to MAX_PAGE_LENGTH
+def build_page(mail_from: str, dest: str, page_body: str, priority=PRIORITY_NORMAL) -> Page:
+    sp = ni.make_packet(FormatUtils.trim_bytes(page_body.encode("ascii", "ignore"), MAX_PAGE_LENGTH), dest, 65535)
+    return Page(mail_from, sp, page_body, priority)
+
+# Build a Page from a received mail. The subject holds the destination address,
+# optionally with URGENT_TAG.
+def make_page(mail_from: str, mail_subject: str, mail_body: str) -> Page:
+    dest = '255.255.255.255'
+    priority = PRIORITY_NORMAL
+    for word in mail_subject.split():
+        if(FormatUtils.is_valid_address(word)):
+            dest = word
+        elif(word.strip("[]!:").upper() == URGENT_TAG.upper()):
+            priority = PRIORITY_URGENT
+    return build_page(mail_from, dest, mail_from + ":\n" + mail_body, priority)
+
+# Should the sender of a page be mailed a confirmation?
+def wants_confirmation(page: Page) -> bool:
+    # Pages submitted locally are from "local" (never mailed), and don't send messages to self
+    return "@" in page.mail_from and page.mail_from != IMAP_ADDR and page.mail_from != SMTP_ADDR
+
+# Rebuild a Page from its journal row
+def load_page(row) -> Page:
+    journal_id, priority, mail_from, dest, page_body, sent_time, arrival_time = row
+    page = build_page(mail_from, dest, page_body, priority)
+    page.journal_id = journal_id
+    page.sent_time = sent_time
+    if(arrival_time > 0): # 0: journaled before arrival times were kept
+        page.arrival_time = arrival_time
+    return page
+
+# Fetch mail and queue it as pages, oldest first
+async def ingest(pages: asyncio.Queue, imap_executor, journal_executor):
+    loop = asyncio.get_running_loop()
+    while(True):
+        try:
+            # Drain every pending message in one round trip
+            start_time = perf_counter()
+            pending = await loop.run_in_executor(imap_executor, im.read_pending)
+            if(len(pending) == 0):
+                await loop.run_in_executor(imap_executor, im.wait) # block until the server reports new mail
+                continue
+            journaled = await loop.run_in_executor(journal_executor, journal.get_mail_uids)
+            accepted = []
+            for uid, mail_from, mail_subject, mail_body, arrival_time in pending:
+                if(uid in journaled):
+                    continue # already paged, but removing the mail failed last time
+                log(0, "Message received from %s.", mail_from)
+                page = make_page(mail_from, mail_subject, mail_body)
+                page.arrival_time = arrival_time
+                page.mail_uid = uid
+                if(page.priority == PRIORITY_URGENT):
+                    log(0, "Page from %s is urgent.", mail_from)
+                accepted.append(page)
+            # Only remove the mail once the pages are safely in the journal
+            await loop.run_in_executor(journal_executor, journal.add, accepted)
+            for page in accepted:
+                await pages.put(page)
+            PAGES_ACCEPTED_MAIL.inc(len(accepted))
+            QUEUE_DEPTH.set(pages.qsize())
+            await loop.run_in_executor(imap_executor, im.remove, [m[0] for m in pending])
+            await loop.run_in_executor(journal_executor, journal.forget_mail_uids, [m[0] for m in pending])
+            INGEST_SECONDS.observe(perf_counter() - start_time)
+            log(0, "%d page(s) queued.", len(accepted))
+        except Exception as e:
+            log(2, "Unexpected error while fetching mail: %s. Restarting after cooldown.", e)
+            await asyncio.sleep(PAGE_COOLDOWN)
+
+# Hand pages to radios, most urgent first. A page whose radios are all busy or out of
+# duty-cycle budget is passed over (and put back) so that pages for other radios aren't held
+# up behind it; it keeps its place for when its radio has room.
+async def schedule(pages: asyncio.PriorityQueue, pool: TransmitterPool, radio_freed: asyncio.Event):
+    while(True):
+        try:
+            radio_freed.clear()
+            if(not pool.has_idle()):
+                await radio_freed.wait()
+                continue
+            page = await pages.get()
+            passed_over = []
+            wait = SCHEDULER_RECHECK_TIME
+            while(True):
+                radio, delay = pool.choose(page)
+                if(radio is not None):
+                    break
+                passed_over.append(page)
+                if(delay is not None):
+                    wait = min(wait, delay)
+                if(pages.empty()):
+                    break
+                page = pages.get_nowait()
+            for p in passed_over:
+                pages.put_nowait(p)
+            if(radio is None):
+                # Wait for a radio to finish or a budget to free up
+                try:
+                    await asyncio.wait_for(radio_freed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            radio.busy = True
+            await radio.tx_pages.put(page)
+            QUEUE_DEPTH.set(pages.qsize())
+        except Exception as e:
+            log(2, "Unexpected error while scheduling: %s. Restarting after cooldown.", e)
+            await asyncio.sleep(PAGE_COOLDOWN)
+
+# Transmit the pages handed to a radio (in its own thread) and queue their confirmations.
+# Every radio runs one of these, so they transmit at the same time.
+async def transmit(radio: Radio, pages: asyncio.PriorityQueue, confirmations: asyncio.Queue, radio_freed: asyncio.Event, journal_executor):
+    loop = asyncio.get_running_loop()
+    while(True):
+        page = await radio.tx_pages.get()
+        radio.page = page
+        start_time = monotonic()
+        waited = 0
+        sent = False
+        try:
+            waited = await loop.run_in_executor(radio.executor, radio.ni.send_packet, page.packet)
+            sent = True
+            log(0, "Sent page:\n%s\nto address %s on radio %s.", page.page_body, page.packet.get_dest(), radio.name)
+            PAGES_TRANSMITTED.inc()
+            radio.pages_sent.inc()
+            PAGE_LATENCY.observe(time() - page.arrival_time)
+            page.sent_time = get_date_and_time()
+            if(wants_confirmation(page)):
+                await loop.run_in_executor(journal_executor, journal.set_state, [page], PAGE_TRANSMITTED)
+                await confirmations.put(page)
+            else:
+                await loop.run_in_executor(journal_executor, journal.set_state, [page], PAGE_CONFIRMED)
+        except Exception as e:
+            if(sent):
+                log(2, "Unexpected error while journaling a sent page: %s.", e)
+            else:
+                TRANSMIT_ERRORS.inc()
+                log(2, "Unexpected error while transmitting on radio %s: %s. Requeueing the page and resting the radio for %ds.", radio.name, e, PAGE_COOLDOWN)
+                pages.put_nowait(page) # sent by another radio, or by this one after its cooldown
+                QUEUE_DEPTH.set(pages.qsize())
+        finally:
+            PAGE_AIRTIME.observe(monotonic() - start_time - waited)
+            radio.duty.record(monotonic() - start_time - waited)
+            radio.page = None
+            radio_freed.set()
+        if(not sent):
+            await asyncio.sleep(PAGE_COOLDOWN)
+        radio.busy = False
+        radio_freed.set()
+
+# Confirmation text for a sent page
+def make_confirmation(page: Page) -> str:
+    return ("The following page...\n" + page.page_body + "\n...to address " + page.packet.get_dest() + " was successfully sent on " + page.sent_time + ".")
+
+# Send confirmations for batches of pages, one message per sender. Returns the pages confirmed.
+def send_confirmations(batch: dict) -> list:
+    sent = []
+    for recipient, confirmed in batch.items():
+        try:
+            sm.send(recipient, OUTGOING_MESSAGE_SUBJECT, OUTGOING_MESSAGE_HEADER + "\n\n".join(make_confirmation(p) for p in confirmed))
+            sent.extend(confirmed)
+            CONFIRMATIONS_SENT.inc()
+        except Exception as e:
+            CONFIRMATION_ERRORS.inc()
+            log(2, "Could not send confirmation to %s: %s.", recipient, e)
+    return sent
+
+# Notify senders that their pages were sent. Confirmations to the same sender within
+# SMTP_COALESCE_TIME are sent as one message.
+async def confirm(confirmations: asyncio.Queue, smtp_executor, journal_executor):
+    loop = asyncio.get_running_loop()
+    while(True):
+        batch = {}
+        sending = None
+        try:
+            page = await confirmations.get()
+            batch = {page.mail_from: [page]}
+            await asyncio.sleep(SMTP_COALESCE_TIME)
+            while(not confirmations.empty()):
+                page = confirmations.get_nowait()
+                batch.setdefault(page.mail_from, []).append(page)
+            sending = loop.run_in_executor(smtp_executor, send_confirmations, batch)
+            sent = await asyncio.shield(sending)
+            await loop.run_in_executor(journal_executor, journal.set_state, sent, PAGE_CONFIRMED)
+        except asyncio.CancelledError:
+            # Shutting down: finish journaling a batch that is being sent, or give a batch still
+            # being collected back to the queue for main() to send
+            if(sending is None):
+                for confirmed in batch.values():
+                    for page in confirmed:
+                        confirmations.put_nowait(page)
+            else:
+                sent = await sending
+                await loop.run_in_executor(journal_executor, journal.set_state, sent, PAGE_CONFIRMED)
+            raise
+        except Exception as e:
+            log(2, "Unexpected error while confirming: %s. Restarting after cooldown.", e)
+            await asyncio.sleep(PAGE_COOLDOWN)
+
+################################################################################ Submission API
+# Local HTTP address pages can be submitted on (set SUBMIT_HTTP_PORT to 0 to disable)
+SUBMIT_HTTP_HOST = "127.0.0.1"
+SUBMIT_HTTP_PORT = 8025
+#
+# Unix domain socket pages can be submitted on, speaking the same HTTP (empty to disable)
+SUBMIT_SOCKET_PATH = "mercury.sock"
+#
+# Largest request body accepted, in bytes
+SUBMIT_MAX_REQUEST = 4 * 1024 * 1024
+#
+# Seconds a client has to send its request
+SUBMIT_TIMEOUT = 10
+
+# Validate submitted page objects ({"body": str, "dest": address, "from": str, "urgent": bool}).
+# "from" only labels the page body: submitted pages are from "local", so that callers can't
+# have confirmations mailed to an address of their choosing.
+# Returns (pages, errors); nothing should be queued if there are any errors.
+def parse_submission(data) -> tuple:
+    if(isinstance(data, dict)):
+        data = [data]
+    if(not isinstance(data, list) or len(data) == 0):
+        return [], ["expected a page object or a list of page objects"]
+    accepted = []
+    errors = []
+    for i in range(len(data)):
+        item = data[i]
+        if(not isinstance(item, dict) or not isinstance(item.get("body"), str)):
+            errors.append(str(i) + ": missing body")
+            continue
+        dest = item.get("dest", "255.255.255.255")
+        if(not isinstance(dest, str) or not FormatUtils.is_valid_address(dest)):
+            errors.append(str(i) + ": invalid dest address")
+            continue
+        label = str(item.get("from", "local"))
+        priority = PRIORITY_URGENT if item.get("urgent") is True else PRIORITY_NORMAL
+        accepted.append(build_page("local", dest, label + ":\n" + item["body"], priority))
+    return accepted, errors
+
+# Write an HTTP response with a JSON body (or a given body and content type) and close the connection
+async def send_response(writer, status: str, reply, content_type="application/json"):
+    if(isinstance(reply, str)):
+        body = reply.encode()
+    else:
+        body = json.dumps(reply).encode()
+    writer.write(("HTTP/1.1 " + status + "\r\nContent-Type: " + content_type + "\r\nContent-Length: "
+                  + str(len(body)) + "\r\nConnection: close\r\n\r\n").encode() + body)
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+# Read one HTTP request. Returns (method, path, body).
+async def read_request(reader) -> tuple:
+    method, path, version = (await reader.readline()).decode("latin-1").split(" ", 2)
+    headers = {}
+    while(True):
+        line = await reader.readline()
+        if(line in (b"\r\n", b"\n", b"")):
+            break
+        name, value = line.decode("latin-1").split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", "0"))
+    if(length > SUBMIT_MAX_REQUEST):
+        raise ValueError("request too large")
+    return method, path, await reader.readexactly(length)
+
+# Handle one HTTP request (TCP or Unix socket): POST /pages with a page object or a list of them,
+# or GET /metrics (Prometheus text) and /metrics.json
+async def handle_submission(reader, writer, pages: asyncio.Queue, journal_executor):
+    loop = asyncio.get_running_loop()
+    try:
+        try:
+            method, path, body = await asyncio.wait_for(read_request(reader), SUBMIT_TIMEOUT)
+        except Exception:
+            await send_response(writer, "400 Bad Request", {"errors": ["malformed request"]})
+            return
+        if(method == "GET" and path.split("?")[0] == "/metrics"):
+            await send_response(writer, "200 OK", metrics.REGISTRY.render_prometheus(), "text/plain; version=0.0.4")
+            return
+        if(method == "GET" and path.split("?")[0] == "/metrics.json"):
+            await send_response(writer, "200 OK", metrics.REGISTRY.render_json())
+            return
+        if(path.split("?")[0] != "/pages"):
+            await send_response(writer, "404 Not Found", {"errors": ["not found"]})
+            return
+        if(method != "POST"):
+            await send_response(writer, "405 Method Not Allowed", {"errors": ["use POST"]})
+            return
+        try:
+            accepted, errors = parse_submission(json.loads(body))
+        except ValueError:
+            accepted, errors = [], ["body is not valid JSON"]
+        if(len(errors) > 0):
+            await send_response(writer, "400 Bad Request", {"errors": errors})
+            return
+        await loop.run_in_executor(journal_executor, journal.add, accepted)
+        for page in accepted:
+            await pages.put(page)
+        PAGES_ACCEPTED_LOCAL.inc(len(accepted))
+        QUEUE_DEPTH.set(pages.qsize())
+        log(0, "%d page(s) submitted locally.", len(accepted))
+        await send_response(writer, "202 Accepted", {"accepted": len(accepted)})
+    except Exception as e:
+        log(1, "Error handling a page submission: %s.", e)
+        writer.close()
+
+# Start the local submission listeners. Returns the servers.
+async def start_submission_servers(pages: asyncio.Queue, journal_executor) -> list:
+    def handler(reader, writer):
+        return handle_submission(reader, writer, pages, journal_executor)
+    servers = []
+    if(SUBMIT_HTTP_PORT != 0):
+        servers.append(await asyncio.start_server(handler, SUBMIT_HTTP_HOST, SUBMIT_HTTP_PORT))
+        log(0, "Accepting pages on http://%s:%d/pages.", SUBMIT_HTTP_HOST, SUBMIT_HTTP_PORT)
+    if(SUBMIT_SOCKET_PATH != "" and hasattr(socket, "AF_UNIX")):
+        if(os.path.exists(SUBMIT_SOCKET_PATH)):
+            os.remove(SUBMIT_SOCKET_PATH) # left over from an unclean exit
+        umask = os.umask(0o177) # only this user may connect
+        try:
+            servers.append(await asyncio.start_unix_server(handler, SUBMIT_SOCKET_PATH))
+        finally:
+            os.umask(umask)
+        log(0, "Accepting pages on unix socket %s.", SUBMIT_SOCKET_PATH)
+    return servers
+
+async def main():
+    loop = asyncio.get_running_loop()
+    imap_executor = ThreadPoolExecutor(1)
+    smtp_executor = ThreadPoolExecutor(1)
+    journal_executor = ThreadPoolExecutor(1)
+    pages = asyncio.PriorityQueue()
+    confirmations = asyncio.Queue()
+    radio_freed = asyncio.Event()
+    for radio in pool.radios:
+        radio.tx_pages = asyncio.Queue(maxsize=1)
+    # Replay pages left over from the last run
+    for row in journal.get(PAGE_QUEUED):
+        pages.put_nowait(load_page(row))
+    for row in journal.get(PAGE_TRANSMITTED):
+        confirmations.put_nowait(load_page(row))
+    if(pages.qsize() + confirmations.qsize() > 0):
+        log(0, "Recovered %d unsent page(s) and %d unconfirmed page(s) from the journal.", pages.qsize(), confirmations.qsize())
+    servers = await start_submission_servers(pages, journal_executor)
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, AttributeError):
+            pass # Not supported on this platform, fall back to KeyboardInterrupt
+    intake = [
+        asyncio.create_task(ingest(pages, imap_executor, journal_executor)),
+        asyncio.create_task(schedule(pages, pool, radio_freed)),
+    ]
+    tasks = [asyncio.create_task(confirm(confirmations, smtp_executor, journal_executor))]
+    for radio in pool.radios:
+        tasks.append(asyncio.create_task(transmit(radio, pages, confirmations, radio_freed, journal_executor)))
+    log(0, "Listening.")
+    try:
+        await stop.wait()
+    finally:
+        log(0, "Shutting down.")
+        for server in servers:
+            server.close()
+        if(SUBMIT_SOCKET_PATH != "" and os.path.exists(SUBMIT_SOCKET_PATH)):
+            os.remove(SUBMIT_SOCKET_PATH)
+        # Stop taking and scheduling pages, and let the radios finish (and journal) the pages
+        # they were handed before transmitting and confirming are stopped
+        for task in intake:
+            task.cancel()
+        im.stop() # wake an IMAP call blocked in IDLE or waiting to reconnect
+        await asyncio.gather(*intake, return_exceptions=True)
+        while(any(radio.page is not None or not radio.tx_pages.empty() for radio in pool.radios)):
+            radio_freed.clear()
+            await radio_freed.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        imap_executor.shutdown(wait=True)
+        pool.shutdown()
+        # Send confirmations for everything that was transmitted
+        batch = {}
+        while(not confirmations.empty()):
+            page = confirmations.get_nowait()
+            batch.setdefault(page.mail_from, []).append(page)
+        smtp_executor.shutdown(wait=True)
+        journal_executor.shutdown(wait=True)
+        journal.set_state(send_confirmations(batch), PAGE_CONFIRMED)
+        sm.disconnect()
+        im.disconnect()
+        journal.close()
+        if(pages.qsize() + pool.get_pending() > 0):
+            log(1, "%d queued page(s) were not sent. They will be sent on next start.", pages.qsize() + pool.get_pending())
 
 ################################################################################ Main Loop
 log(0, "----- Mercury Pager Server -----")
@@ -161,32 +1067,10 @@ log(0, "- Homepage: https://github.com/jmeifert/mercurypager")
 log(0, "- Updates: https://github.com/jmeifert/mercurypager/releases")
 im = IMAP(IMAP_ADDR, IMAP_PASSWORD, IMAP_SERVER, IMAP_PORT)
 sm = SMTP(SMTP_ADDR, SMTP_PASSWORD, SMTP_SERVER, SMTP_PORT)
-ni = NetworkInterface(SOURCE_ADDRESS, 65535)
-while(True):
-    try:
-        if(im.getMessageCount() > 0):
-            # Fetch mail
-            mail_from, mail_subject, mail_body = im.read_last(remove=True)
-            log(0, "Message received from " + mail_from + ".")
-            # Assemble packet
-            if(FormatUtils.is_valid_address(mail_subject)):
-                dest = mail_subject
-            else:
-                dest = '255.255.255.255'
-            page_body = mail_from + ":\n" + mail_body 
-            sp = ni.make_packet(FormatUtils.trim_bytes(page_body.encode("ascii", "ignore"), MAX_PAGE_LENGTH), dest, 65535)
-            # Send packet
-            ni.send_packet(sp)
-            # Notify sender that packet was sent
-            log(0, "Sent page:\n" + page_body + "\nto address " + sp.get_dest() + ".")
-            if(mail_from != IMAP_ADDR and mail_from != SMTP_ADDR): # don't send messages to self
-                sm.send(mail_from, OUTGOING_MESSAGE_SUBJECT, (OUTGOING_MESSAGE_HEADER + "The following page...\n" + page_body + "\n...to address " + sp.get_dest() + " was successfully sent on " + get_date_and_time() + "."))
-            # Cool down
-            sleep(PAGE_COOLDOWN)
-            log(0, "Listening.")
-        else:
-            sleep(3) # mail check cooldown
-
-    except Exception as e:
-        log(2, "Unexpected error: " + str(e) + ". Restarting after cooldown.")
-        sleep(PAGE_COOLDOWN)
+pool = load_pool(TX_RADIOS)
+ni = pool.radios[0].ni # makes Packets (every radio sends from SOURCE_ADDRESS)
+journal = PageJournal(JOURNAL_PATH)
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    pass
@@ -0,0 +1,186 @@
+"""
+x----------------------------------------------x
+| Page store - Indexed, searchable record of   |
+| every page a receiver hears.                 |
+x----------------------------------------------x
+"""
+import atexit
+import queue
+import sqlite3
+import threading
+from time import time
+from adrcfs import FormatUtils
+import mercurylog
+
+################################################################################ PROGRAM DEFAULTS
+# Where to keep the store
+STORE_PATH = "mercury-pages.db"
+#
+# Most packets written in one transaction
+STORE_BATCH_SIZE = 256
+#
+# Seconds the writer waits for more packets before committing what it has
+STORE_FLUSH_INTERVAL = 1.0
+#
+# Default number of results returned by search()
+STORE_SEARCH_LIMIT = 50
+
+################################################################################ LOGGING
+# Logging level (0: INFO, 1: WARN (recommended), 2: ERROR, 3: NONE)
+LOG_LEVEL = 0
+#
+# How the log identifies which module is logging. (Log output is configured in mercurylog.py)
+LOG_PREFIX = "(PageStore)"
+
+log = mercurylog.get_logger(LOG_PREFIX, LOG_LEVEL)
+
+################################################################################ STORE
+# Addresses are stored as 32-bit integers so that their indexes stay small
+def pack_address(address: str) -> int:
+    return FormatUtils.bytes_to_int(bytes(FormatUtils.parse_address(address)))
+
+def unpack_address(address: int) -> str:
+    return FormatUtils.make_address(list(FormatUtils.int_to_bytes(address, 4)))
+
+class PageStore: # Received packets in SQLite (WAL mode), written in batches by a background thread
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        db = sqlite3.connect(path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS packets (
+            id INTEGER PRIMARY KEY,
+            received REAL NOT NULL,
+            source INTEGER NOT NULL,
+            dest INTEGER NOT NULL,
+            source_port INTEGER NOT NULL,
+            dest_port INTEGER NOT NULL,
+            flag INTEGER NOT NULL,
+            age INTEGER NOT NULL,
+            integrity REAL NOT NULL,
+            device TEXT,
+            parent INTEGER,
+            data BLOB NOT NULL)""")
+        db.execute("CREATE INDEX IF NOT EXISTS packets_received ON packets (received)")
+        db.execute("CREATE INDEX IF NOT EXISTS packets_source ON packets (source, received)")
+        db.execute("CREATE INDEX IF NOT EXISTS packets_dest ON packets (dest, received)")
+        # Contentless: the body text lives in packets.data, the index only maps words to ids
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS packets_fts USING fts5(body, content='')")
+        db.commit()
+        db.close()
+        self.records = queue.SimpleQueue()
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.reader_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.__write_loop, name="pagestore", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    # Queue a received Packet (and the Packets grouped in it) to be stored. Never blocks on I/O.
+    def add(self, p, integrity=1.0, device=None, received=None):
+        if(received is None):
+            received = time()
+        self.records.put((p, integrity, device, received))
+
+    # Wait until everything added so far has been written
+    def flush(self):
+        if(self.thread.is_alive()):
+            done = threading.Event()
+            self.records.put(done)
+            done.wait()
+
+    # Write everything added so far and stop the writer
+    def close(self):
+        if(self.thread.is_alive()):
+            self.records.put(None)
+            self.thread.join()
+            self.reader.close()
+
+    # Insert one packet and its full-text entry, returning its id. A GROUP container's body is
+    # not indexed, since the packets inside it are indexed on their own.
+    def __insert(self, db, p, integrity: float, device, received: float, parent=None) -> int:
+        data = bytes(p.get_data())
+        cur = db.execute("""INSERT INTO packets (received, source, dest, source_port, dest_port, flag, age,
+            integrity, device, parent, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (received, pack_address(p.get_source()), pack_address(p.get_dest()), p.get_source_port(),
+             p.get_dest_port(), int(p.get_flag(), 2), p.get_age(), integrity, device, parent, data))
+        if(not p.is_group_flag()):
+            db.execute("INSERT INTO packets_fts (rowid, body) VALUES (?, ?)", (cur.lastrowid, data.decode("ascii", "ignore")))
+        return cur.lastrowid
+
+    def __write_batch(self, db, batch: list):
+        with db:
+            for p, integrity, device, received in batch:
+                parent = self.__insert(db, p, integrity, device, received)
+                if(p.is_group_flag()):
+                    for v in p.iter_grouped_packets():
+                        self.__insert(db, v, integrity, device, received, parent)
+
+    def __write_loop(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA synchronous=NORMAL") # a crash may lose the last batch, never corrupt the store
+        while True:
+            record = self.records.get()
+            batch = []
+            waiting = [] # flush() events to set once the batch is committed
+            closing = False
+            while True:
+                if(record is None):
+                    closing = True
+                elif(isinstance(record, threading.Event)):
+                    waiting.append(record)
+                else:
+                    batch.append(record)
+                if(closing or len(waiting) > 0 or len(batch) == 0 or len(batch) >= STORE_BATCH_SIZE):
+                    break
+                try:
+                    record = self.records.get(timeout=STORE_FLUSH_INTERVAL)
+                except queue.Empty:
+                    break
+            if(len(batch) > 0):
+                try:
+                    self.__write_batch(db, batch)
+                except sqlite3.Error as e:
+                    log(2, "Could not store %d packets: %s.", len(batch), e)
+            for done in waiting:
+                done.set()
+            if(closing):
+                db.close()
+                return
+
+    # Find stored packets, newest first. text is an FTS5 query on the body ("fire AND station",
+    # "evac*"); source and dest are addresses; since and until are Unix times. Returns tuples of
+    # (id, received, source, source port, dest, dest port, flag, age, integrity, device, parent id, data).
+    def search(self, text=None, source=None, dest=None, since=None, until=None, limit=STORE_SEARCH_LIMIT) -> list:
+        query = "SELECT p.id, p.received, p.source, p.source_port, p.dest, p.dest_port, p.flag, p.age, p.integrity, p.device, p.parent, p.data FROM "
+        conditions = []
+        args = []
+        if(text is not None):
+            query += "packets_fts JOIN packets p ON p.id = packets_fts.rowid"
+            conditions.append("packets_fts MATCH ?")
+            args.append(text)
+        else:
+            query += "packets p"
+        if(source is not None):
+            conditions.append("p.source = ?")
+            args.append(pack_address(source))
+        if(dest is not None):
+            conditions.append("p.dest = ?")
+            args.append(pack_address(dest))
+        if(since is not None):
+            conditions.append("p.received >= ?")
+            args.append(since)
+        if(until is not None):
+            conditions.append("p.received < ?")
+            args.append(until)
+        if(len(conditions) > 0):
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY p.received DESC LIMIT ?"
+        args.append(limit)
+        with self.reader_lock:
+            rows = self.reader.execute(query, args).fetchall()
+        return [(r[0], r[1], unpack_address(r[2]), r[3], unpack_address(r[4]), r[5], '{0:08b}'.format(r[6]),
+                 r[7], r[8], r[9], r[10], r[11]) for r in rows]
+
+    # Get the number of stored packets
+    def count(self) -> int:
+        with self.reader_lock:
+            return self.reader.execute("SELECT COUNT(*) FROM packets").fetchone()[0]